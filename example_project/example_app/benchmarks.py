@@ -0,0 +1,215 @@
+"""
+Benchmarks for the overhead of HistoricalRecords, run by
+"manage.py history_benchmark". Every benchmark returns a dictionary which
+can be dumped as JSON, with timings in microseconds and the number of
+queries per call.
+"""
+import datetime
+import platform
+import timeit
+from contextlib import contextmanager
+
+import django
+from django.db import connection, models
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from example_app.models import TestModel, WideModel
+
+
+def measure(func, repeat):
+    """
+    Call func(i) repeat times and return statistics about the calls.
+    """
+    timings = []
+    queries = 0
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = timeit.default_timer()
+            func(i)
+            timings.append((timeit.default_timer() - start) * 1e6)
+        queries += len(context.captured_queries)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'mean_us': sum(timings) / repeat,
+        'median_us': timings[repeat // 2],
+        'p95_us': timings[min(repeat - 1, int(repeat * 0.95))],
+        'min_us': timings[0],
+        'queries': float(queries) / repeat,
+    }
+
+
+@contextmanager
+def with_history(model):
+    """
+    Leave the HistoricalRecords of model as they are.
+    """
+    yield
+
+
+@contextmanager
+def without_history(model):
+    """
+    Disconnect the signal handlers of the HistoricalRecords of model.
+    """
+    records = model._historical_records
+    models.signals.post_save.disconnect(records.post_save, sender=model)
+    models.signals.post_delete.disconnect(records.post_delete, sender=model)
+    try:
+        yield
+    finally:
+        models.signals.post_save.connect(records.post_save, sender=model, weak=False)
+        models.signals.post_delete.connect(records.post_delete, sender=model, weak=False)
+
+
+def make_wide(i, **kwargs):
+    attrs = dict(title='Title %d' % i, slug='slug-%d' % i, summary='Summary ' * 20,
+                 body='Body ' * 200, views=i, score=i / 3.0, price='12.50')
+    attrs.update(kwargs)
+    return WideModel(**attrs)
+
+
+def change_wide(obj):
+    obj.views += 1
+
+
+def make_test(i, **kwargs):
+    return TestModel(characters='Characters %d' % i, **kwargs)
+
+
+def change_test(obj):
+    obj.characters += '!'
+
+
+FACTORIES = (
+    (TestModel, make_test, change_test),
+    (WideModel, make_wide, change_wide),
+)
+
+
+def bench_writes(repeat):
+    """
+    Latency and queries of creating, changing and deleting an object, with
+    and without history.
+    """
+    results = {}
+    sequence = [0]
+
+    def new(factory):
+        sequence[0] += 1
+        return factory(sequence[0])
+
+    for model, factory, change_field in FACTORIES:
+        model_results = results[model.__name__] = {}
+        for label, context in (('history', with_history), ('no_history', without_history)):
+            with context(model):
+                objs = []
+
+                def create(i):
+                    obj = new(factory)
+                    obj.save()
+                    objs.append(obj)
+
+                def change(i):
+                    change_field(objs[i])
+                    objs[i].save()
+
+                def unchanged(i):
+                    objs[i].save()
+
+                def delete(i):
+                    objs[i].delete()
+
+                model_results[label] = {
+                    'create': measure(create, repeat),
+                    'change': measure(change, repeat),
+                    'save_unchanged': measure(unchanged, repeat),
+                    'delete': measure(delete, repeat),
+                }
+    return results
+
+
+def add_versions(obj, count, batch_size=1000):
+    """
+    Insert count historical records for obj, one second apart, ending now.
+    Returns the date of the record in the middle.
+    """
+    records = obj._historical_records
+    history_model = records.history_model
+    attrs = records.get_historical_attrs(obj)
+    start = timezone.now() - datetime.timedelta(seconds=count)
+    batch = []
+    for i in range(count):
+        attrs['views'] = i
+        batch.append(history_model(history_type='~' if i else '+',
+                                   history_date=start + datetime.timedelta(seconds=i),
+                                   **attrs))
+        if len(batch) == batch_size:
+            history_model._default_manager.bulk_create(batch)
+            batch = []
+    history_model._default_manager.bulk_create(batch)
+    return start + datetime.timedelta(seconds=count // 2)
+
+
+def bench_reads(versions, repeat):
+    """
+    Latency of most_recent(), as_of() and modified_fields as the number of
+    versions of an object grows.
+    """
+    results = {}
+    for count in versions:
+        with without_history(WideModel):
+            obj = make_wide(count, slug='versions-%d' % count)
+            obj.save()
+        middle = add_versions(obj, count)
+        page = min(50, count)
+
+        def modified_fields(i):
+            for entry in obj.history.all()[:page]:
+                entry.modified_fields
+
+        def with_changes(i):
+            for entry in obj.history.with_changes()[:page]:
+                entry.modified_fields
+
+        def iter_changes(i):
+            for revision in obj.history.iter_changes():
+                pass
+
+        results[str(count)] = {
+            'most_recent': measure(lambda i: obj.history.most_recent(), repeat),
+            'as_of': measure(lambda i: obj.history.as_of(middle), repeat),
+            'modified_fields_page': measure(modified_fields, max(1, repeat // 10)),
+            'with_changes_page': measure(with_changes, max(1, repeat // 10)),
+            'iter_changes_all': measure(iter_changes, 1),
+            'page_size': page,
+        }
+    return results
+
+
+def bench_bulk(count):
+    """
+    Throughput of bulk_create() with and without history, in rows per second.
+    """
+    results = {}
+    for label, queryset in (('history', WideModel.objects.all()),
+                            ('no_history', models.QuerySet(WideModel))):
+        objs = [make_wide(i, slug='bulk-%s-%d' % (label, i)) for i in range(count)]
+        stats = measure(lambda i: queryset.bulk_create(objs), 1)
+        stats['rows_per_second'] = count / (stats['mean_us'] / 1e6)
+        results[label] = stats
+    return results
+
+
+def run(repeat=200, versions=(10, 100, 1000, 10000, 100000), bulk=10000):
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+        },
+        'writes': bench_writes(repeat),
+        'reads': bench_reads(versions, repeat),
+        'bulk_create': bench_bulk(bulk),
+    }
@@ -0,0 +1,36 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from example_app import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Measure the overhead of HistoricalRecords on a new test database, '
+            'and write the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200,
+                            help='Number of calls measured for every operation.')
+        parser.add_argument('--versions', default='10,100,1000,10000,100000',
+                            help='Comma-separated numbers of versions per object for the reads.')
+        parser.add_argument('--bulk', type=int, default=10000,
+                            help='Number of objects created by bulk_create().')
+        parser.add_argument('--output', help='File to write the results to, instead of stdout.')
+
+    def handle(self, **options):
+        versions = [int(count) for count in options['versions'].split(',')]
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = benchmarks.run(options['repeat'], versions, options['bulk'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        else:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
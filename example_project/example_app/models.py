@@ -1,11 +1,17 @@
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+from history.manager import TrackedManager
 from history.models import HistoricalRecords
+from history.cache import LocMemSnapshotCache
+from history.writers import QueuedWriter
 
 class TestModel(models.Model):
     """A model for testing"""
     boolean = models.BooleanField(default=True)
     characters = models.CharField(blank=True, max_length=100)
-    
+
+    objects = TrackedManager()
     history = HistoricalRecords()
     
     class Admin:
@@ -14,3 +20,132 @@ class TestModel(models.Model):
 
     def __unicode__(self):
         return u"TestModel"
+
+class TrackedModel(models.Model):
+    """A model which keeps its last known state on the instance"""
+    boolean = models.BooleanField(default=True)
+    characters = models.CharField(blank=True, max_length=100)
+
+    history = HistoricalRecords(track_state=True)
+
+    def __unicode__(self):
+        return u"TrackedModel"
+
+class BufferedModel(models.Model):
+    """A model which writes its history when the transaction commits"""
+    characters = models.CharField(blank=True, max_length=100)
+
+    objects = TrackedManager()
+    history = HistoricalRecords(buffered=True, indexes=[('characters', 'history_id')])
+
+    def __unicode__(self):
+        return u"BufferedModel"
+
+class DeltaModel(models.Model):
+    """A model which only saves the changed fields in its history"""
+    boolean = models.BooleanField(default=True)
+    characters = models.CharField(blank=True, max_length=100)
+    number = models.IntegerField(default=0)
+    date = models.DateField(null=True, blank=True)
+    timestamp = models.DateTimeField(null=True, blank=True)
+
+    history = HistoricalRecords(keyframe_interval=3)
+
+    def __unicode__(self):
+        return u"DeltaModel"
+
+queued_writer = QueuedWriter(maxsize=4, workers=2, batch_size=3)
+
+
+class QueuedModel(models.Model):
+    """A model which saves its history from background threads"""
+    characters = models.CharField(blank=True, max_length=100)
+
+    history = HistoricalRecords(writer=queued_writer)
+
+    def __unicode__(self):
+        return u"QueuedModel"
+
+class PartialModel(models.Model):
+    """A model which only saves some of its fields in its history"""
+    boolean = models.BooleanField(default=True)
+    characters = models.CharField(blank=True, max_length=100)
+
+    history = HistoricalRecords(fields=['characters'])
+
+    def __unicode__(self):
+        return u"PartialModel"
+
+class RoutedModel(models.Model):
+    """A model whose history is written to another database"""
+    characters = models.CharField(blank=True, max_length=100)
+
+    history = HistoricalRecords(using='history', read_using='default')
+
+    def __unicode__(self):
+        return u"RoutedModel"
+
+class CoalescedModel(models.Model):
+    """A model whose changes within a minute share a historical record"""
+    characters = models.CharField(blank=True, max_length=100)
+    number = models.IntegerField(default=0)
+
+    history = HistoricalRecords(coalesce_seconds=60, keyframe_interval=3)
+
+    def __unicode__(self):
+        return u"CoalescedModel"
+
+class VersionedModel(models.Model):
+    """A model whose historical records are numbered"""
+    characters = models.CharField(blank=True, max_length=100)
+
+    objects = TrackedManager()
+    history = HistoricalRecords(versioned=True)
+
+    def __unicode__(self):
+        return u"VersionedModel"
+
+class CachedModel(models.Model):
+    """A model whose past states are cached"""
+    characters = models.CharField(blank=True, max_length=100)
+
+    history = HistoricalRecords(cache=LocMemSnapshotCache(maxsize=2), coalesce_seconds=60)
+
+    def __unicode__(self):
+        return u"CachedModel"
+
+class FingerprintModel(models.Model):
+    """A model whose history saves a fingerprint of its fields"""
+    characters = models.CharField(blank=True, max_length=100)
+    body = models.TextField(blank=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    score = models.FloatField(default=0.0)
+
+    objects = TrackedManager()
+    history = HistoricalRecords(fingerprint=True)
+
+    def __unicode__(self):
+        return u"FingerprintModel"
+
+
+class WideModel(models.Model):
+    """A wide model with foreign keys, for the benchmarks"""
+    test_model = models.ForeignKey(TestModel, on_delete=models.CASCADE, null=True, blank=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
+    title = models.CharField(max_length=200)
+    slug = models.SlugField(max_length=200, unique=True)
+    summary = models.CharField(blank=True, max_length=500)
+    body = models.TextField(blank=True)
+    status = models.CharField(max_length=20, default='draft')
+    views = models.IntegerField(default=0)
+    score = models.FloatField(default=0.0)
+    price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    published = models.BooleanField(default=False)
+    created = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(default=timezone.now)
+
+    objects = TrackedManager()
+    history = HistoricalRecords()
+
+    def __unicode__(self):
+        return self.title
@@ -5,7 +5,982 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import datetime
+import threading
+from decimal import Decimal
+
+from django.db import close_old_connections, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from example_app.models import BufferedModel, CachedModel, CoalescedModel, DeltaModel, FingerprintModel, PartialModel, QueuedModel
+from example_app.models import RoutedModel, TestModel
+from example_app.models import TrackedModel, VersionedModel
+from example_app.models import queued_writer
+
+
+class HistoricalRecordsTest(TestCase):
+    def test_create_and_change(self):
+        obj = TestModel.objects.create(boolean=True, characters='abc')
+        self.assertEqual(obj.history.count(), 1)
+        self.assertEqual(obj.history.get().history_type, '+')
+
+        obj.characters = 'def'
+        obj.save()
+        self.assertEqual(obj.history.count(), 2)
+        self.assertEqual(obj.history.most_recent().characters, 'def')
+
+    def test_unchanged_save_is_skipped(self):
+        obj = TestModel.objects.create(characters='abc')
+        obj.save()
+        self.assertEqual(obj.history.count(), 1)
+
+    def test_delete(self):
+        obj = TestModel.objects.create(characters='abc')
+        pk = obj.pk
+        obj.delete()
+        history = TestModel.history.filter(id=pk)
+        self.assertEqual([h.history_type for h in history], ['-', '+'])
+
+    def test_composite_indexes(self):
+        table = TestModel.history.model._meta.db_table
+        cursor = connection.cursor()
+        constraints = connection.introspection.get_constraints(cursor, table)
+        indexes = [c['columns'] for c in constraints.values() if c['index']]
+        self.assertIn(['id', 'history_id'], indexes)
+        self.assertIn(['id', 'history_date'], indexes)
+        self.assertNotIn(['id'], indexes)
+
+    def test_extra_indexes(self):
+        table = BufferedModel.history.model._meta.db_table
+        cursor = connection.cursor()
+        constraints = connection.introspection.get_constraints(cursor, table)
+        indexes = [c['columns'] for c in constraints.values() if c['index']]
+        self.assertIn(['characters', 'history_id'], indexes)
+
+
+class TrackStateTest(TestCase):
+    def test_save_does_not_query_history(self):
+        obj = TrackedModel.objects.create(characters='abc')
+        obj = TrackedModel.objects.get(pk=obj.pk)
+        # UPDATE and INSERT, no SELECT on the history table.
+        obj.characters = 'def'
+        with self.assertNumQueries(2):
+            obj.save()
+        # Only the UPDATE.
+        with self.assertNumQueries(1):
+            obj.save()
+        self.assertEqual(obj.history.count(), 2)
+
+    def test_create_does_not_query_history(self):
+        # INSERT of the object and INSERT of the historical record.
+        with self.assertNumQueries(2):
+            obj = TrackedModel.objects.create(characters='abc')
+        self.assertEqual(obj.history.get().history_type, '+')
+
+    def test_unsaved_instance_with_pk_falls_back(self):
+        obj = TrackedModel.objects.create(characters='abc')
+        TrackedModel(pk=obj.pk, characters='abc').save()
+        self.assertEqual(obj.history.count(), 1)
+        TrackedModel(pk=obj.pk, characters='def').save()
+        self.assertEqual(obj.history.count(), 2)
+
+    def test_refresh_from_db(self):
+        obj = TrackedModel.objects.create(characters='one')
+        other = TrackedModel.objects.get(pk=obj.pk)
+        other.characters = 'two'
+        other.save()
+        obj.refresh_from_db()
+        obj.characters = 'one'
+        obj.save()
+        self.assertEqual(obj.history.most_recent().characters, 'one')
+        self.assertEqual(obj.history.count(), 3)
+
+        other.characters = 'three'
+        other.save()
+        obj.refresh_from_db(fields=['boolean'])
+        obj.save()
+        self.assertEqual(obj.history.most_recent().characters, 'one')
+        self.assertEqual(obj.history.count(), 5)
+
+    def test_deferred_fields_fall_back(self):
+        obj = TrackedModel.objects.create(characters='abc')
+        obj = TrackedModel.objects.only('boolean').get(pk=obj.pk)
+        obj.boolean = False
+        obj.save()
+        self.assertEqual(obj.history.count(), 2)
+
+
+class PartialFieldsTest(TestCase):
+    def test_untracked_field_is_ignored(self):
+        obj = PartialModel.objects.create(boolean=True, characters='abc')
+        obj.boolean = False
+        obj.save()
+        self.assertEqual(obj.history.count(), 1)
+        self.assertEqual(obj.history.most_recent().characters, 'abc')
+
+    def test_as_of(self):
+        obj = PartialModel.objects.create(characters='abc')
+        date = timezone.now()
+        obj.characters = 'def'
+        obj.save()
+        old = obj.history.as_of(date)
+        self.assertEqual(old.pk, obj.pk)
+        self.assertEqual(old.characters, 'abc')
+        self.assertEqual(obj.history.all()[1].history_object.characters, 'abc')
+
+
+class FingerprintTest(TestCase):
+    def test_fingerprint(self):
+        obj = FingerprintModel.objects.create(characters='first', body='body ' * 100, price='1.5')
+        record = obj.history.get()
+        self.assertEqual(len(record.history_fingerprint), 40)
+        self.assertEqual(record.history_fingerprint,
+                         FingerprintModel.history.plan.fingerprint(
+                             [obj.pk, 'first', 'body ' * 100, Decimal('1.50'), 0.0]))
+
+        # An unchanged save only fetches the fingerprint
+        with CaptureQueriesContext(connection) as context:
+            obj.save()
+        self.assertEqual(obj.history.count(), 1)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertNotIn('"body"', context.captured_queries[1]['sql'])
+
+        obj.characters = 'second'
+        obj.save()
+        obj.characters = 'first'
+        obj.save()
+        first, second, third = obj.history.order_by('history_id')
+        self.assertTrue(first.same_state_as(third))
+        self.assertFalse(first.same_state_as(second))
+        self.assertEqual([change.name for change in third.modified_fields], ['characters'])
+
+    def test_float(self):
+        obj = FingerprintModel.objects.create(score=0.1234567890123)
+        obj.score = 0.1234567890124
+        obj.save()
+        self.assertEqual(obj.history.count(), 2)
+
+    def test_without_fingerprint(self):
+        obj = FingerprintModel.objects.create(characters='first')
+        obj.history.update(history_fingerprint=None)
+        obj.save()
+        self.assertEqual(obj.history.count(), 1)
+        obj.characters = 'second'
+        obj.save()
+        self.assertEqual(obj.history.count(), 2)
+
+    def test_bulk(self):
+        objs = FingerprintModel.objects.bulk_create([FingerprintModel(characters='a'),
+                                                     FingerprintModel(characters='b')])
+        FingerprintModel.objects.update(characters='c')
+        records = list(FingerprintModel.history.order_by('history_id'))
+        self.assertNotIn(None, [record.history_fingerprint for record in records])
+        self.assertFalse(records[0].same_state_as(records[2]))
+        objs[0].refresh_from_db()
+        objs[0].save()
+        self.assertEqual(objs[0].history.count(), 2)
+
+
+class RoutingTest(TestCase):
+    multi_db = True
+
+    def test_routing(self):
+        obj = RoutedModel.objects.create(characters='first')
+        with CaptureQueriesContext(connection) as default, \
+             CaptureQueriesContext(connections['history']) as history:
+            obj.save()
+            obj.characters = 'second'
+            obj.save()
+        self.assertEqual(len(default.captured_queries), 2)
+        self.assertEqual(len(history.captured_queries), 3)
+        self.assertEqual(RoutedModel.history.using('history').count(), 2)
+
+        # Reads go to read_using, which is not a replica here.
+        with CaptureQueriesContext(connection) as default:
+            self.assertEqual(obj.history.count(), 0)
+        self.assertEqual(len(default.captured_queries), 1)
+        self.assertEqual(obj.history.db_manager('history').most_recent().characters, 'second')
+
+    def test_router(self):
+        from history.routers import HistoryRouter
+        router = HistoryRouter()
+        history_model = RoutedModel.history.model
+        self.assertEqual(router.db_for_write(history_model), 'history')
+        self.assertEqual(router.db_for_read(history_model), 'default')
+        self.assertEqual(router.db_for_write(TestModel.history.model), None)
+        self.assertTrue(router.allow_migrate('history', 'example_app', 'historicalroutedmodel'))
+        self.assertFalse(router.allow_migrate('other', 'example_app', 'historicalroutedmodel'))
+        self.assertEqual(router.allow_migrate('history', 'example_app', 'routedmodel'), None)
+
+
+class CoalesceTest(TestCase):
+    def test_coalesce(self):
+        obj = CoalescedModel.objects.create(characters='first')
+        for i in range(1, 6):
+            obj.number = i
+            obj.save()
+        self.assertEqual([(entry.history_type, entry.number) for entry in obj.history.all()],
+                         [('~', 5), ('+', 0)])
+        self.assertEqual(obj.history.most_recent().number, 5)
+
+        # Older changes are kept
+        obj.history.filter(history_type='~').update(
+            history_date=timezone.now() - datetime.timedelta(minutes=2))
+        obj.number = 6
+        obj.save()
+        obj.characters = 'second'
+        obj.save()
+        entries = list(obj.history.all())
+        self.assertEqual([(entry.history_type, entry.number) for entry in entries],
+                         [('~', 6), ('~', 5), ('+', 0)])
+        self.assertEqual(entries[0].characters, 'second')
+        self.assertEqual(entries[0].history_delta, None)
+
+        obj.delete()
+        self.assertEqual(CoalescedModel.history.count(), 4)
+
+    def test_improperly_configured(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from history.models import HistoricalRecords
+        self.assertRaises(ImproperlyConfigured, HistoricalRecords, coalesce_seconds=5, buffered=True)
+
+
+class RetentionTest(TestCase):
+    def add_versions(self, obj, dates):
+        for date in dates:
+            obj.characters = date.isoformat()
+            obj.save()
+            obj.history.filter(history_id=obj.history.all()[0].history_id).update(history_date=date)
+
+    def test_select_deleted(self):
+        from history.retention import select_deleted
+        now = timezone.now()
+        day = datetime.timedelta(days=1)
+        rows = [(6, '~', now), (5, '-', now - day), (4, '~', now - 2 * day),
+                (3, '~', now - 2 * day - datetime.timedelta(hours=1)), (2, '~', now - 3 * day),
+                (1, '+', now - 10 * day)]
+        self.assertEqual(select_deleted(rows, keep_last=3), [3, 2, 1])
+        self.assertEqual(select_deleted(rows, before=now - 2 * day), [3, 2, 1])
+        self.assertEqual(select_deleted(rows, thin='day', before=now - day), [3])
+        self.assertEqual(select_deleted(rows, keep_last=5, thin='day'), [])
+
+    def test_compact(self):
+        from history.retention import compact
+        now = timezone.now()
+        objs = [TestModel.objects.create(characters='%d' % i) for i in range(3)]
+        for obj in objs:
+            self.add_versions(obj, [now - datetime.timedelta(days=days) for days in (4, 3, 2, 1)])
+        deleted_pk = objs[2].pk
+        objs[2].delete()
+        progress = []
+        self.assertEqual(compact(TestModel, keep_last=2, chunk_size=2,
+                                 progress=lambda *args: progress.append(args[1:])),
+                         (3, 10))
+        self.assertEqual(progress, [(objs[1].pk, 2, 6), (deleted_pk, 3, 10)])
+        self.assertEqual(objs[0].history.count(), 2)
+        self.assertEqual(objs[0].history.most_recent().characters, objs[0].characters)
+        self.assertEqual([entry.history_type for entry in
+                          TestModel.history.filter(id=deleted_pk)], ['-', '~'])
+
+        # Resume after the first object
+        self.assertEqual(compact(TestModel, keep_last=1, start_after=objs[0].pk), (2, 2))
+        self.assertEqual(objs[0].history.count(), 2)
+        self.assertEqual(objs[1].history.count(), 1)
+
+    def test_delta(self):
+        from history.retention import compact
+        now = timezone.now()
+        obj = DeltaModel.objects.create(characters='first')
+        self.add_versions(obj, [now - datetime.timedelta(days=days) for days in range(6, 0, -1)])
+        states = [entry.characters for entry in obj.history.all()]
+        self.assertNotEqual(obj.history.all()[1].history_delta, None)
+        compact(DeltaModel, keep_last=2)
+        entries = list(obj.history.all())
+        self.assertEqual([entry.characters for entry in entries], states[:2])
+        self.assertEqual(entries[-1].history_delta, None)
+        self.assertEqual(obj.history.most_recent().characters, obj.characters)
+
+    def test_chunks_within_object(self):
+        from history.retention import compact
+        now = timezone.now()
+        obj = DeltaModel.objects.create(characters='first')
+        self.add_versions(obj, [now - datetime.timedelta(days=days) for days in range(9, 0, -1)])
+        states = [entry.characters for entry in obj.history.all()]
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(compact(DeltaModel, keep_last=3, chunk_size=2), (1, 7))
+        # The 10 records are read 2 at a time.
+        self.assertTrue(len([q for q in context.captured_queries if 'LIMIT 2' in q['sql']]) >= 5)
+        entries = list(obj.history.all())
+        self.assertEqual([entry.characters for entry in entries], states[:3])
+        self.assertEqual(entries[-1].history_delta, None)
+
+    def test_command(self):
+        from django.core.management import CommandError, call_command
+        from django.utils.six import StringIO
+        obj = TestModel.objects.create(characters='first')
+        self.add_versions(obj, [timezone.now() - datetime.timedelta(days=10)])
+        output = StringIO()
+        call_command('history_compact', 'example_app.TestModel', older_than=5, dry_run=True,
+                     stdout=output)
+        self.assertEqual(output.getvalue(), 'example_app.TestModel: 1 objects, 0 records would be deleted.\n')
+        self.assertRaises(CommandError, call_command, 'history_compact', 'example_app.TestModel')
+        self.assertRaises(CommandError, call_command, 'history_compact', 'auth.User', keep_last=1)
+
+
+class BackfillTest(TestCase):
+    def test_backfill(self):
+        from django.db import models
+        from history.backfill import backfill
+        models.QuerySet(TestModel).bulk_create([TestModel(characters='%d' % i) for i in range(5)])
+        tracked = TestModel.objects.create(characters='tracked')
+        objs = list(TestModel.objects.order_by('pk'))
+        progress = []
+        self.assertEqual(backfill(TestModel, chunk_size=4, start_after=objs[0].pk,
+                                  progress=lambda *args: progress.append(args[1:])),
+                         (5, 4))
+        self.assertEqual(progress, [(objs[4].pk, 4, 4), (tracked.pk, 5, 4)])
+        self.assertEqual(objs[1].history.most_recent().characters, '1')
+        self.assertEqual(objs[1].history.get().history_type, '+')
+        self.assertEqual(tracked.history.count(), 1)
+        self.assertEqual(objs[0].history.count(), 0)
+
+    def test_command(self):
+        from django.core.management import call_command
+        from django.db import models
+        from django.utils.six import StringIO
+        models.QuerySet(FingerprintModel).bulk_create([FingerprintModel(characters='a')])
+        output = StringIO()
+        call_command('history_backfill', 'example_app.FingerprintModel', stdout=output)
+        call_command('history_backfill', 'example_app.FingerprintModel', stdout=output)
+        self.assertEqual(output.getvalue(), 'example_app.FingerprintModel: 1 objects, 1 records created.\n'
+                                            'example_app.FingerprintModel: 1 objects, 0 records created.\n')
+        self.assertNotEqual(FingerprintModel.history.get().history_fingerprint, None)
+
+
+class ExportTest(TestCase):
+    def test_jsonl(self):
+        import json
+        from django.utils.six import StringIO
+        from history.export import export
+        obj = DeltaModel.objects.create(characters='first', number=1)
+        for number in range(2, 5):
+            obj.number = number
+            obj.save()
+        other = DeltaModel.objects.create(characters='other')
+
+        output = StringIO()
+        count, last_id = export(DeltaModel, output, diffs=True, chunk_size=2)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual((count, last_id), (5, other.history.get().history_id))
+        self.assertEqual([(line['id'], line['number']) for line in lines],
+                         [(obj.pk, 1), (obj.pk, 2), (obj.pk, 3), (obj.pk, 4), (other.pk, 0)])
+        self.assertEqual(lines[2]['changes'], {'number': [2, 3]})
+        self.assertEqual(lines[0]['history_type'], '+')
+
+        # Incremental export
+        obj.characters = 'second'
+        obj.save()
+        output = StringIO()
+        count, new_last_id = export(DeltaModel, output, after_id=last_id, diffs=True)
+        line = json.loads(output.getvalue())
+        self.assertEqual((line['characters'], line['number']), ('second', 4))
+        self.assertEqual(line['changes'], {'characters': ['first', 'second']})
+        self.assertEqual((count, new_last_id), (1, line['history_id']))
+
+    def test_csv(self):
+        import csv
+        from django.utils.six import StringIO
+        from history.export import export
+        obj = TestModel.objects.create(characters='first')
+        TestModel.objects.create(characters='other')
+        output = StringIO()
+        self.assertEqual(export(TestModel, output, format='csv', object_pk=obj.pk)[0], 1)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual(rows[0], ['history_id', 'history_date', 'history_type', 'history_editor_id',
+                                   'id', 'boolean', 'characters'])
+        self.assertEqual(rows[1][2:], ['+', '', str(obj.pk), 'True', 'first'])
+
+    def test_command(self):
+        import gzip
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        TestModel.objects.create(characters='first')
+        handle, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+        try:
+            errors = StringIO()
+            call_command('history_export', 'example_app.TestModel', output=path, gzip=True,
+                         stderr=errors)
+            with gzip.open(path) as output:
+                lines = output.read().decode('utf-8').splitlines()
+        finally:
+            os.remove(path)
+        self.assertEqual(json.loads(lines[0])['characters'], 'first')
+        self.assertTrue(errors.getvalue().startswith('example_app.TestModel: 1 records'))
+
+
+class PageTest(TestCase):
+    def test_page(self):
+        obj = VersionedModel.objects.create(characters='0')
+        for i in range(1, 5):
+            obj.characters = '%d' % i
+            obj.save()
+        self.assertEqual([entry.history_version for entry in obj.history.all()], [5, 4, 3, 2, 1])
+
+        with CaptureQueriesContext(connection) as context:
+            page = obj.history.page(limit=2)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertNotIn('COUNT', context.captured_queries[1]['sql'])
+        self.assertNotIn('OFFSET', context.captured_queries[0]['sql'])
+        self.assertEqual([entry.characters for entry in page], ['4', '3'])
+        self.assertEqual(page.total, 5)
+
+        page = obj.history.page(before_id=page.next_before_id, limit=2)
+        self.assertEqual([entry.characters for entry in page], ['2', '1'])
+        page = obj.history.page(before_id=page.next_before_id, limit=2)
+        self.assertEqual([entry.characters for entry in page], ['0'])
+        self.assertEqual(page.next_before_id, None)
+
+        page = obj.history.with_changes().page(limit=1)
+        self.assertEqual(page.entries[0].modified_fields[0].from_value, '3')
+        self.assertEqual(page.total, None)
+
+    def test_versions(self):
+        objs = VersionedModel.objects.bulk_create([VersionedModel(characters='a'),
+                                                   VersionedModel(characters='b')])
+        VersionedModel.objects.update(characters='c')
+        objs[0].history.update(history_version=None)
+        objs[0].characters = 'd'
+        objs[0].save()
+        self.assertEqual(objs[0].history.count_versions(), 3)
+        self.assertEqual(objs[1].history.count_versions(), 2)
+        self.assertEqual(TestModel.objects.create().history.page().total, 1)
+
+    def test_compacted(self):
+        from history.retention import compact
+        obj = VersionedModel.objects.create(characters='0')
+        for i in range(1, 6):
+            obj.characters = '%d' % i
+            obj.save()
+        self.assertEqual(compact(VersionedModel, keep_last=2), (1, 4))
+        self.assertEqual(obj.history.count_versions(), 2)
+        self.assertEqual(obj.history.page().total, 2)
+        obj.characters = '6'
+        obj.save()
+        self.assertEqual(obj.history.count_versions(), 3)
+        self.assertEqual(compact(VersionedModel, keep_last=3), (1, 0))
+        self.assertEqual(obj.history.count_versions(), 3)
+
+
+class AsOfTest(TestCase):
+    def test_all_as_of(self):
+        first = TestModel.objects.create(characters='first')
+        second = TestModel.objects.create(characters='second')
+        date = timezone.now()
+        first.characters = 'changed'
+        first.save()
+        second.delete()
+        third = TestModel.objects.create(characters='third')
+        deleted = TestModel.objects.create(characters='deleted')
+        deleted.delete()
+
+        with self.assertNumQueries(1):
+            objs = list(TestModel.history.as_of(date))
+        self.assertEqual([o.characters for o in objs], ['first', 'second'])
+        self.assertTrue(all(isinstance(o, TestModel) for o in objs))
+
+        objs = TestModel.history.as_of(timezone.now())
+        self.assertEqual([o.characters for o in objs], ['changed', 'third'])
+
+    def test_all_as_of_queryset(self):
+        TestModel.objects.create(characters='abc')
+        other = TestModel.objects.create(characters='def')
+        queryset = TestModel.objects.filter(pk=other.pk)
+        objs = TestModel.history.as_of(timezone.now(), queryset)
+        self.assertEqual([o.pk for o in objs], [other.pk])
+
+
+class SnapshotCacheTest(TestCase):
+    def setUp(self):
+        self.cache = CachedModel.history.model._historical_records._cache
+        self.cache.clear()
+
+    def test_as_of(self):
+        obj = CachedModel.objects.create(characters='first')
+        created = timezone.now()
+        obj.characters = 'second'
+        obj.save()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(obj.history.as_of(created).characters, 'first')
+            self.assertEqual(obj.history.as_of(created).characters, 'first')
+        self.assertEqual(len(context.captured_queries), 3)
+
+        # The most recent change is coalesced into the same record, which
+        # is never cached.
+        changed = timezone.now()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(obj.history.as_of(changed).characters, 'second')
+            self.assertEqual(obj.history.as_of(changed).characters, 'second')
+        self.assertEqual(len(context.captured_queries), 4)
+        latest_id = obj.history.values_list('history_id', flat=True)[0]
+        self.assertEqual(self.cache.get(CachedModel.history.model, obj.pk, latest_id), None)
+        obj.characters = 'third'
+        obj.save()
+        self.assertEqual(obj.history.as_of(created).characters, 'first')
+        self.assertEqual(obj.history.as_of(changed).characters, 'third')
+        self.assertRaises(CachedModel.DoesNotExist, obj.history.as_of,
+                          created - datetime.timedelta(seconds=1))
+
+    def test_lru(self):
+        objs = [CachedModel.objects.create(characters='%d' % i) for i in range(3)]
+        now = timezone.now()
+        for obj in objs:
+            obj.characters += '!'
+            obj.save()
+            obj.history.as_of(now)
+        with CaptureQueriesContext(connection) as context:
+            objs[2].history.as_of(now)
+            objs[0].history.as_of(now)
+        self.assertEqual(len(context.captured_queries), 3)
+
+    def test_entries_limit(self):
+        from history.cache import LocMemSnapshotCache
+        cache = LocMemSnapshotCache(maxsize=2)
+        model = CachedModel.history.model
+        for history_id in range(100):
+            cache.set(model, 1, history_id, ('state',))
+        cache.set(model, 2, 1, ('other',))
+        self.assertEqual(len(cache._states), 2)
+        self.assertEqual(cache.get(model, 1, 99), ('state',))
+        self.assertEqual(cache.get(model, 1, 98), None)
+        cache.invalidate(model, 1)
+        self.assertEqual(cache.get(model, 1, 99), None)
+        self.assertEqual(cache.get(model, 2, 1), ('other',))
+        self.assertEqual(cache._objects, {(model._meta.label, 2): set([1])})
+
+    def test_django_cache(self):
+        from history.cache import DjangoSnapshotCache
+        records = CachedModel.history.model._historical_records
+        records._cache = DjangoSnapshotCache(prefix='test-history')
+        try:
+            obj = CachedModel.objects.create(characters='first')
+            key = (CachedModel.history.model, obj.pk, obj.history.get().history_id)
+            created = timezone.now()
+            obj.characters = 'second'
+            obj.save()
+            obj.history.as_of(created)
+            self.assertEqual(records._cache.get(*key), (obj.pk, 'first'))
+            obj.characters = 'third'
+            obj.save()
+            self.assertEqual(records._cache.get(*key), None)
+        finally:
+            records._cache = self.cache
+
+
+class WithChangesTest(TestCase):
+    def test_modified_fields(self):
+        obj = TestModel.objects.create(boolean=True, characters='abc')
+        for characters in ['def', 'ghi', 'jkl']:
+            obj.characters = characters
+            obj.save()
+        obj.boolean = False
+        obj.save()
+
+        with self.assertNumQueries(1):
+            entries = list(obj.history.with_changes())
+            changes = [[(c.name, c.from_value, c.to_value) for c in e.modified_fields]
+                       for e in entries]
+        self.assertEqual(changes[0], [('boolean', True, False)])
+        self.assertEqual(changes[1], [('characters', 'ghi', 'jkl')])
+        self.assertEqual(len(changes[-1]), 3)
+        self.assertEqual(entries[0].modified_fields[0].verbose_name, 'boolean')
+
+    def test_previous_entry_outside_of_page(self):
+        obj = TestModel.objects.create(characters='abc')
+        obj.characters = 'def'
+        obj.save()
+        with self.assertNumQueries(2):
+            entries = list(obj.history.with_changes().filter(history_type='~'))
+            self.assertEqual(entries[0].previous_entry.characters, 'abc')
+        self.assertEqual(entries[0].modified_fields[0].from_value, 'abc')
+
+
+class IterChangesTest(TestCase):
+    def test_iter_changes(self):
+        obj = TestModel.objects.create(boolean=True, characters='a')
+        for characters in 'bcde':
+            obj.characters = characters
+            obj.save()
+        other = TestModel.objects.create(characters='x')
+
+        with self.assertNumQueries(3):
+            revisions = list(TestModel.history.iter_changes(chunk_size=3))
+        self.assertEqual([r.object_pk for r in revisions], [obj.pk] * 5 + [other.pk])
+        self.assertEqual([r.history_type for r in revisions], ['+'] + ['~'] * 4 + ['+'])
+        self.assertEqual(len(revisions[0].changes), 3)
+        self.assertEqual([(c.name, c.from_value, c.to_value) for c in revisions[2].changes],
+                         [('characters', 'b', 'c')])
+        self.assertEqual(len(revisions[5].changes), 3)
+
+        revisions = list(obj.history.iter_changes())
+        self.assertEqual(len(revisions), 5)
+        self.assertFalse(hasattr(revisions[0], '__dict__'))
+
+
+class DeltaTest(TestCase):
+    def setUp(self):
+        self.obj = DeltaModel.objects.create(characters='a', number=1)
+        self.dates = [timezone.now()]
+        for number in range(2, 8):
+            self.obj.number = number
+            if number == 4:
+                self.obj.date = datetime.date(2010, 9, 10)
+            self.obj.save()
+            self.dates.append(timezone.now())
+
+    def test_storage(self):
+        rows = DeltaModel.history.model._base_manager.order_by('history_id') \
+                                 .values_list('history_delta', 'number')
+        self.assertEqual([number for delta, number in rows],
+                         [1, None, None, 4, None, None, 7])
+        self.assertEqual(rows[1][0], '{"number":2}')
+        self.assertEqual(rows[2][0], '{"number":3}')
+        self.assertEqual(rows[4][0], '{"number":5}')
+
+    def test_datetime(self):
+        timestamp = timezone.now().replace(microsecond=123456)
+        self.obj.timestamp = timestamp
+        self.obj.save()
+        self.assertEqual(self.obj.history.most_recent().timestamp, timestamp)
+        self.obj.save()
+        self.assertEqual(self.obj.history.count(), 8)
+
+    def test_iterator(self):
+        expected = [(entry.number, entry.characters) for entry in self.obj.history.all()]
+        self.assertEqual([(entry.number, entry.characters)
+                          for entry in self.obj.history.iterator(chunk_size=3)], expected)
+        self.assertEqual([entry.modified_fields[0].from_value
+                          for entry in self.obj.history.with_changes().iterator()][:2], [6, 5])
+
+    def test_most_recent(self):
+        with self.assertNumQueries(1):
+            most_recent = self.obj.history.most_recent()
+        self.assertEqual(most_recent.number, 7)
+        self.assertEqual(most_recent.characters, 'a')
+        self.assertEqual(most_recent.date, datetime.date(2010, 9, 10))
+
+    def test_as_of(self):
+        for number, date in enumerate(self.dates, 1):
+            old = self.obj.history.as_of(date)
+            self.assertEqual(old.number, number)
+            self.assertEqual(old.characters, 'a')
+        self.assertEqual(self.obj.history.as_of(self.dates[4]).date,
+                         datetime.date(2010, 9, 10))
+        self.assertEqual(self.obj.history.as_of(self.dates[1]).date, None)
+
+    def test_all_as_of(self):
+        objs = list(DeltaModel.history.as_of(self.dates[5]))
+        self.assertEqual([o.number for o in objs], [6])
+
+    def test_history_object(self):
+        entries = list(self.obj.history.all())
+        self.assertEqual([e.number for e in entries], [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual(entries[1].history_object.date, datetime.date(2010, 9, 10))
+        raw = DeltaModel.history.model._base_manager.get(history_id=entries[1].history_id)
+        self.assertEqual(raw.history_object.number, 6)
+
+    def test_iter_changes(self):
+        revisions = list(self.obj.history.iter_changes())
+        changes = [(c.name, c.from_value, c.to_value) for c in revisions[3].changes]
+        self.assertEqual(sorted(changes), [('date', None, datetime.date(2010, 9, 10)),
+                                           ('number', 3, 4)])
+        self.assertEqual([c.to_value for c in revisions[6].changes], [7])
+
+    def test_modified_fields(self):
+        entries = list(self.obj.history.with_changes())
+        changes = [(c.name, c.from_value, c.to_value) for c in entries[3].modified_fields]
+        self.assertEqual(sorted(changes), [('date', None, datetime.date(2010, 9, 10)),
+                                           ('number', 3, 4)])
+
+
+class QueuedWriterTest(TransactionTestCase):
+    def test_written_by_workers(self):
+        for i in range(20):
+            obj = QueuedModel.objects.create(characters=str(i))
+            obj.characters += '!'
+            obj.save()
+        queued_writer.flush()
+        self.assertEqual(QueuedModel.history.count(), 40)
+        self.assertEqual(obj.history.most_recent().characters, '19!')
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                QueuedModel.objects.create(characters='abc')
+                raise ValueError
+        except ValueError:
+            pass
+        queued_writer.flush()
+        self.assertEqual(QueuedModel.history.count(), 0)
+
+    def test_reverted_change(self):
+        with transaction.atomic():
+            obj = QueuedModel.objects.create(characters='one')
+            obj.characters = 'two'
+            obj.save()
+            obj.characters = 'one'
+            obj.save()
+        queued_writer.flush()
+        self.assertEqual([entry.characters for entry in obj.history.all()], ['one', 'two', 'one'])
+
+        obj.save()
+        queued_writer.flush()
+        self.assertEqual(obj.history.count(), 3)
+
+    def test_rolled_back_savepoint(self):
+        obj = QueuedModel.objects.create(characters='one')
+        with transaction.atomic():
+            obj.characters = 'two'
+            obj.save()
+            try:
+                with transaction.atomic():
+                    obj.characters = 'three'
+                    obj.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            obj.characters = 'two'
+            obj.save()
+        queued_writer.flush()
+        self.assertEqual([entry.characters for entry in obj.history.all()], ['two', 'one'])
+
+    @override_settings(HISTORY_SYNCHRONOUS_WRITES=True)
+    def test_synchronous(self):
+        obj = QueuedModel.objects.create(characters='abc')
+        self.assertEqual(obj.history.count(), 1)
+
+    def test_spill_keeps_order(self):
+        from history import writers
+        writer = writers.QueuedWriter(maxsize=1, workers=1, batch_size=1, policy='spill')
+        records = QueuedModel._historical_records
+        release = threading.Event()
+        records._writer = writer
+        # The worker waits before saving, so that the queue fills up.
+        writers.close_old_connections = lambda: release.wait()
+        threading.Timer(0.5, release.set).start()
+        try:
+            obj = QueuedModel.objects.create(characters='v1')
+            for characters in ['v2', 'v3', 'v4']:
+                obj.characters = characters
+                obj.save()
+            writer.flush()
+        finally:
+            records._writer = queued_writer
+            writers.close_old_connections = close_old_connections
+            writer.close()
+        history = obj.history.order_by('history_id')
+        self.assertEqual([h.characters for h in history], ['v1', 'v2', 'v3', 'v4'])
+
+
+class BulkTest(TestCase):
+    def test_bulk_create(self):
+        objs = TestModel.objects.bulk_create(
+            [TestModel(characters=str(i)) for i in range(5)])
+        self.assertEqual(TestModel.history.filter(history_type='+').count(), 5)
+        self.assertEqual(objs[0].history.get().characters, '0')
+
+    def test_update(self):
+        for i in range(3):
+            TestModel.objects.create(characters=str(i))
+        with CaptureQueriesContext(connection) as context:
+            # SELECT of the primary keys, UPDATE, SELECT of the new values
+            # and INSERT of the historical records.
+            TestModel.objects.filter(characters__in=['0', '1']).update(characters='x')
+        self.assertEqual(len(context.captured_queries), 4)
+        # Only the rows whose primary keys were read are updated.
+        self.assertIn('"id" IN', context.captured_queries[1]['sql'])
+        changed = TestModel.history.filter(history_type='~')
+        self.assertEqual(sorted(h.characters for h in changed), ['x', 'x'])
+
+    def test_update_untracked_field(self):
+        obj = TestModel.objects.create(characters='abc')
+        TestModel.objects.filter(pk=obj.pk).update(id=obj.pk)
+        self.assertEqual(obj.history.count(), 2)
+
+    def test_bulk_update(self):
+        objs = [TestModel.objects.create(characters=str(i)) for i in range(3)]
+        for obj in objs:
+            obj.characters += '!'
+        TestModel.objects.bulk_update(objs, ['characters'])
+        self.assertEqual(objs[2].history.most_recent().characters, '2!')
+
+    def test_delete(self):
+        objs = [TestModel.objects.create(characters=str(i)) for i in range(3)]
+        TestModel.objects.all().delete()
+        deleted = TestModel.history.filter(history_type='-')
+        self.assertEqual(sorted(h.id for h in deleted), sorted(o.pk for o in objs))
+
+
+class BufferedTest(TransactionTestCase):
+    def test_written_on_commit(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                obj = BufferedModel.objects.create(characters='abc')
+                other = BufferedModel.objects.create(characters='abc')
+                obj.characters = 'def'
+                obj.save()
+                obj.characters = 'ghi'
+                obj.save()
+                self.assertEqual(BufferedModel.history.count(), 0)
+        inserts = [q for q in queries
+                   if q['sql'].startswith('INSERT INTO "example_app_historicalbufferedmodel"')]
+        self.assertEqual(len(inserts), 1)
+        history = obj.history.get()
+        self.assertEqual(history.history_type, '+')
+        self.assertEqual(history.characters, 'ghi')
+        self.assertEqual(other.history.count(), 1)
+
+    def test_delete_is_kept(self):
+        with transaction.atomic():
+            obj = BufferedModel.objects.create(characters='abc')
+            obj.characters = 'def'
+            obj.save()
+            obj.delete()
+        types = [h.history_type for h in BufferedModel.history.all()]
+        self.assertEqual(types, ['-', '+'])
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                BufferedModel.objects.create(characters='abc')
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            BufferedModel.objects.create(characters='def')
+        self.assertEqual([h.characters for h in BufferedModel.history.all()], ['def'])
+
+    def test_savepoint_rollback(self):
+        with transaction.atomic():
+            BufferedModel.objects.create(characters='abc')
+            try:
+                with transaction.atomic():
+                    BufferedModel.objects.create(characters='def')
+                    raise ValueError
+            except ValueError:
+                pass
+            BufferedModel.objects.create(characters='ghi')
+        characters = sorted(h.characters for h in BufferedModel.history.all())
+        self.assertEqual(characters, ['abc', 'ghi'])
+
+    def test_savepoint_release(self):
+        obj = BufferedModel.objects.create(characters='start')
+        with transaction.atomic():
+            obj.characters = 'a'
+            obj.save()
+            with transaction.atomic():
+                obj.characters = 'b'
+                obj.save()
+            obj.characters = 'c'
+            obj.save()
+        history = obj.history.order_by('history_id')
+        self.assertEqual([h.characters for h in history], ['start', 'a', 'b', 'c'])
+        self.assertEqual(obj.history.most_recent().characters, 'c')
+
+    def test_released_savepoint_rolled_back(self):
+        with transaction.atomic():
+            obj = BufferedModel.objects.create(characters='abc')
+            try:
+                with transaction.atomic():
+                    with transaction.atomic():
+                        obj.characters = 'def'
+                        obj.save()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual([h.characters for h in obj.history.all()], ['abc'])
+
+    def test_autocommit(self):
+        obj = BufferedModel.objects.create(characters='abc')
+        self.assertEqual(obj.history.count(), 1)
+
+    def test_bulk_after_save(self):
+        obj = BufferedModel.objects.create(characters='a')
+        with transaction.atomic():
+            obj.characters = 'b'
+            obj.save()
+            BufferedModel.objects.filter(pk=obj.pk).update(characters='c')
+            self.assertEqual(obj.history.count(), 1)
+        self.assertEqual(obj.history.most_recent().characters, 'c')
+
+        pk = obj.pk
+        with transaction.atomic():
+            obj.characters = 'd'
+            obj.save()
+            BufferedModel.objects.filter(pk=pk).delete()
+        history = BufferedModel.history.filter(id=pk).order_by('history_id')
+        self.assertEqual([(h.history_type, h.characters) for h in history],
+                         [('+', 'a'), ('~', 'c'), ('~', 'd'), ('-', 'd')])
+        self.assertRaises(BufferedModel.DoesNotExist, obj.history.as_of, timezone.now())
+
+
+class BenchmarkTest(TestCase):
+    def test_run(self):
+        from example_app import benchmarks
+        results = benchmarks.run(repeat=2, versions=[3], bulk=3)
+        writes = results['writes']['WideModel']
+        self.assertTrue(writes['history']['change']['queries'] >
+                        writes['no_history']['change']['queries'])
+        self.assertEqual(results['reads']['3']['most_recent']['queries'], 1)
+        self.assertIn('rows_per_second', results['bulk_create']['history'])
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        from history.instrumentation import StatsSink, instrumentation
+        self.instrumentation = instrumentation
+        self.sink = StatsSink()
+        instrumentation.add_sink(self.sink)
+
+    def tearDown(self):
+        self.instrumentation.remove_sink(self.sink)
+
+    def test_phases(self):
+        obj = TestModel.objects.create(characters='first')
+        obj.save()
+        obj.characters = 'second'
+        obj.save()
+        obj.delete()
+        TestModel.objects.bulk_create([TestModel(characters='a'), TestModel(characters='b')])
+
+        stats = self.sink.stats['example_app.TestModel']
+        self.assertEqual(stats['lookup']['calls'], 3)
+        self.assertEqual(stats['diff']['calls'], 2)
+        self.assertEqual(stats['skipped']['calls'], 1)
+        self.assertEqual(stats['write']['calls'], 4)
+        self.assertEqual(stats['write']['count'], 5)
+        self.assertTrue(stats['write']['total'] >= stats['write']['max'] > 0)
+
+    def test_signal(self):
+        from history.instrumentation import SignalSink
+        from history.signals import history_metric
+        received = []
+        sink = SignalSink()
+        self.instrumentation.add_sink(sink)
+        history_metric.connect(lambda sender, **kwargs: received.append((sender, kwargs['phase'])),
+                               weak=False, dispatch_uid='test_signal')
+        try:
+            TrackedModel.objects.create(characters='first')
+        finally:
+            history_metric.disconnect(dispatch_uid='test_signal')
+            self.instrumentation.remove_sink(sink)
+        self.assertEqual(received, [(TrackedModel, 'write')])
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
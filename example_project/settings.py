@@ -17,9 +17,18 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+        # The background threads of QueuedWriter can't see an in-memory database.
+        'TEST': {'NAME': 'example_app_test.db'},
+    },
+    # The historical records of RoutedModel are written here.
+    'history': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'example_history.db',
+    },
 }
 
+DATABASE_ROUTERS = ['history.routers.HistoryRouter']
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -93,5 +102,6 @@ INSTALLED_APPS = (
     # 'django.contrib.admin',
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
+    'history',
     'example_app',
 )
@@ -0,0 +1,60 @@
+"""
+Backfill, which creates a first historical record for the existing objects
+of a model which was just given HistoricalRecords.
+
+    from history.backfill import backfill
+    backfill(MyModel)
+
+The objects are read in chunks in primary key order, using keyset
+pagination, and the records of every chunk are created with one
+bulk_create() in their own transaction. Objects which already have a
+historical record are skipped, so an interrupted backfill can simply be
+run again, or resumed after the last primary key it reported.
+"""
+from django.db import transaction
+
+from history.writers import save_records
+
+
+def backfill(model, chunk_size=1000, start_after=None, using=None, dry_run=False, progress=None):
+    """
+    Create a '+' historical record, dated now, for every object of model
+    without any historical record. using is the database of the objects.
+    progress is called with (model, last primary key, objects, created)
+    after every chunk.
+
+    Returns the number of objects read and of records created.
+    """
+    records = model._historical_records
+    plan = records.plan
+    pk_name = plan.pk_name
+    history_using = records.db_for_write()
+    history = records.history_model._base_manager.using(history_using)
+    queryset = model._base_manager.using(using).order_by(pk_name).values_list(*plan.names)
+    pk_index = plan.positions[pk_name]
+
+    objects = created = 0
+    last = start_after
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(**{'%s__gt' % pk_name: last})
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            break
+        pks = [row[pk_index] for row in rows]
+
+        with transaction.atomic(using=history_using):
+            existing = set(history.filter(**{'%s__in' % pk_name: pks})
+                                  .values_list(pk_name, flat=True).distinct())
+            attrs_list = [dict(zip(plan.names, row)) for row in rows
+                          if row[pk_index] not in existing]
+            if attrs_list and not dry_run:
+                save_records(records.build_historical_records(attrs_list, None, '+'))
+
+        objects += len(rows)
+        created += len(attrs_list)
+        last = pks[-1]
+        if progress is not None:
+            progress(model, last, objects, created)
+    return objects, created
@@ -0,0 +1,159 @@
+import threading
+
+from django.db import connections
+
+
+class TransactionBuffer(object):
+    """
+    Gathers historical records while a transaction is open, and writes them
+    in the order they were added, with one bulk_create() per historical
+    model, when it commits.
+
+    Every record remembers the savepoints which were open when it was
+    added, so that the ones added inside a savepoint which is rolled back
+    are discarded together with it. Consecutive changes of the same object
+    within a savepoint are collapsed into a single record.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def _transactions(self):
+        try:
+            return self._local.transactions
+        except AttributeError:
+            self._local.transactions = transactions = {}
+            return transactions
+
+    def _transaction(self, connection):
+        """
+        Return the BufferedTransaction of the transaction open on
+        connection, or None.
+        """
+        transactions = self._transactions()
+        current = transactions.get(connection.alias)
+        if current is not None and not current.is_registered(connection):
+            # Anything which isn't registered anymore was rolled back.
+            del transactions[connection.alias]
+            current = None
+        return current
+
+    def add(self, record, key, using):
+        """
+        Buffer record until the transaction on the database alias using
+        commits. key identifies the object the record belongs to.
+        """
+        self.extend([record], [key], using)
+
+    def extend(self, records, keys, using):
+        """
+        Buffer records of the same historical model, with the keys of their
+        objects, or write them right away outside of a transaction.
+        """
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            if records:
+                records[0]._historical_records.write_records(records, using)
+            return
+        current = self._transaction(connection)
+        if current is None:
+            current = self._transactions()[using] = BufferedTransaction(self, using)
+        for record, key in zip(records, keys):
+            current.add(record, key, connection)
+
+    def pending(self, key, using):
+        """
+        Return the last record buffered for key which has not been written
+        yet, or None.
+        """
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            return None
+        current = self._transaction(connection)
+        if current is None:
+            return None
+        entry = current.latest(key, current.live_markers(connection))
+        return entry and entry[1]
+
+    def discard(self, using):
+        self._transactions().pop(using, None)
+
+
+class SavepointMarker(object):
+    """
+    Registered with on_commit() for the savepoints a record was added in,
+    it's dropped by Django when one of them is rolled back, and only runs
+    when they were all committed.
+    """
+    committed = False
+
+    def commit(self):
+        self.committed = True
+
+
+class BufferedTransaction(object):
+    def __init__(self, buffer, using):
+        self.buffer = buffer
+        self.using = using
+        # [marker, record] in the order they were added, with None as the
+        # record of the entries which were collapsed into a later one.
+        self.entries = []
+        self.by_key = {}
+        self.markers = {}
+
+    def is_registered(self, connection):
+        for sids, func in connection.run_on_commit:
+            if func == self.flush:
+                return True
+        return False
+
+    def live_markers(self, connection):
+        markers = (getattr(func, '__self__', None) for sids, func in connection.run_on_commit)
+        return set(marker for marker in markers if isinstance(marker, SavepointMarker))
+
+    def latest(self, key, live):
+        for entry in reversed(self.by_key.get(key, ())):
+            if entry[0] in live:
+                return entry
+        return None
+
+    def add(self, record, key, connection):
+        live = self.live_markers(connection)
+        # atomic(savepoint=False) adds None, and is rolled back with the
+        # block around it.
+        savepoint_ids = tuple(sid for sid in connection.savepoint_ids if sid is not None)
+        marker = self.markers.get(savepoint_ids)
+        if marker not in live:
+            marker = self.markers[savepoint_ids] = SavepointMarker()
+            connection.on_commit(marker.commit)
+            live.add(marker)
+
+        entries = self.by_key.setdefault(key, [])
+        previous = self.latest(key, live)
+        if previous is not None and previous[0] is marker and record.history_type == '~' \
+                and previous[1].history_type != '-':
+            # Keep the type of the record which is replaced, so that a
+            # creation followed by changes is still saved as a creation.
+            record.history_type = previous[1].history_type
+            previous[1] = None
+            entries.remove(previous)
+        entry = [marker, record]
+        entries.append(entry)
+        self.entries.append(entry)
+
+        # The markers run before flush(), which then knows which savepoints
+        # were rolled back.
+        connection.run_on_commit = [(sids, func) for sids, func in connection.run_on_commit
+                                    if func != self.flush]
+        connection.run_on_commit.append((set(), self.flush))
+
+    def flush(self):
+        self.buffer.discard(self.using)
+        by_model = {}
+        for marker, record in self.entries:
+            if record is not None and marker.committed:
+                by_model.setdefault(record.__class__, []).append(record)
+        for model, records in by_model.items():
+            model._historical_records.write_records(records, self.using)
+
+
+buffer = TransactionBuffer()
@@ -0,0 +1,103 @@
+"""
+Caches for the states rebuilt by HistoryManager.as_of().
+
+    history = HistoricalRecords(cache=LocMemSnapshotCache(maxsize=1000))
+
+as_of() first finds the historical record of the date, with a query which
+only reads its history_id, and then looks up the values of the fields of
+that record in the cache, keyed by the historical model, the object and the
+history_id. A historical record normally never changes once saved, except
+the most recent one of an object with coalesce_seconds, which is then
+never cached. The entries of an object are also dropped whenever
+HistoricalRecords saves or updates one of its records directly.
+"""
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+
+class LocMemSnapshotCache(object):
+    """
+    Keeps the maxsize states used most recently, in the memory of the
+    process.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+        # The history_ids in _states of every object, for invalidate()
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, model, object_pk, history_id):
+        key = (model._meta.label, object_pk, history_id)
+        with self._lock:
+            values = self._states.pop(key, None)
+            if values is not None:
+                self._states[key] = values
+            return values
+
+    def set(self, model, object_pk, history_id, values):
+        key = (model._meta.label, object_pk, history_id)
+        with self._lock:
+            self._states.pop(key, None)
+            self._states[key] = values
+            self._objects.setdefault(key[:2], set()).add(history_id)
+            while len(self._states) > self.maxsize:
+                old_key, old_values = self._states.popitem(last=False)
+                history_ids = self._objects[old_key[:2]]
+                history_ids.discard(old_key[2])
+                if not history_ids:
+                    del self._objects[old_key[:2]]
+
+    def invalidate(self, model, object_pk):
+        label = model._meta.label
+        with self._lock:
+            for history_id in self._objects.pop((label, object_pk), ()):
+                del self._states[(label, object_pk, history_id)]
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._objects.clear()
+
+
+class DjangoSnapshotCache(object):
+    """
+    Keeps the states in one of the caches of the CACHES setting, so that
+    they are shared between processes. The entries of an object are
+    invalidated by incrementing a generation number which is part of their
+    keys.
+    """
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT, prefix='history'):
+        self.alias = alias
+        self.timeout = timeout
+        self.prefix = prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _generation_key(self, model, object_pk):
+        return '%s:%s:%s:generation' % (self.prefix, model._meta.label, object_pk)
+
+    def _key(self, model, object_pk, history_id):
+        generation = self.cache.get(self._generation_key(model, object_pk), 0)
+        return '%s:%s:%s:%s:%s' % (self.prefix, model._meta.label, object_pk, generation, history_id)
+
+    def get(self, model, object_pk, history_id):
+        return self.cache.get(self._key(model, object_pk, history_id))
+
+    def set(self, model, object_pk, history_id, values):
+        self.cache.set(self._key(model, object_pk, history_id), values, self.timeout)
+
+    def invalidate(self, model, object_pk):
+        key = self._generation_key(model, object_pk)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, None)
+
+    def clear(self):
+        self.cache.clear()
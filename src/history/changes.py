@@ -0,0 +1,55 @@
+class HistoryChange(object):
+    __slots__ = ('name', 'from_value', 'to_value', 'verbose_name')
+
+    def __init__(self, name, from_value, to_value, verbose_name):
+        self.name = name
+        self.from_value = from_value
+        self.to_value = to_value
+        self.verbose_name = verbose_name
+
+    def __unicode__(self):
+        return 'Field "%s" changed from "%s" to "%s"' % (self.name, self.from_value, self.to_value)
+
+
+class HistoryRevision(object):
+    """
+    A lightweight copy of a historical record, with the changes it made.
+    Returned by HistoryManager.iter_changes().
+    """
+    __slots__ = ('history_id', 'history_date', 'history_type', 'history_editor_id',
+                 'object_pk', 'changes')
+
+    def __init__(self, history_id, history_date, history_type, history_editor_id,
+                 object_pk, changes):
+        self.history_id = history_id
+        self.history_date = history_date
+        self.history_type = history_type
+        self.history_editor_id = history_editor_id
+        self.object_pk = object_pk
+        self.changes = changes
+
+    def __unicode__(self):
+        return u'%s of %s as of %s' % (self.history_type, self.object_pk, self.history_date)
+
+
+class HistoryPage(object):
+    """
+    A page of historical records, newest first. Returned by
+    HistoryManager.page().
+
+    - entries: the historical records
+    - next_before_id: the before_id of the next page, or None on the last one
+    - total: the number of records of the object, when known
+    """
+    __slots__ = ('entries', 'next_before_id', 'total')
+
+    def __init__(self, entries, next_before_id, total=None):
+        self.entries = entries
+        self.next_before_id = next_before_id
+        self.total = total
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
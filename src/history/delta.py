@@ -0,0 +1,113 @@
+"""
+Delta-encoded historical records.
+
+With HistoricalRecords(keyframe_interval=N), a change only stores the
+fields which differ from the previous record, encoded as JSON in the
+history_delta column, while the copied columns are left empty. Every N-th
+record, and every creation and deletion, is a keyframe: a full copy of the
+fields, with history_delta set to NULL.
+
+The full state of a record is rebuilt from the last keyframe before it and
+the deltas which follow that keyframe.
+"""
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class BrokenHistory(Exception):
+    """ No keyframe was found before a delta-encoded historical record. """
+
+
+class PreciseJSONEncoder(DjangoJSONEncoder):
+    """
+    DjangoJSONEncoder, without rounding datetimes and times to milliseconds.
+    """
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(PreciseJSONEncoder, self).default(o)
+
+
+def encode_delta(changes):
+    return json.dumps(changes, cls=PreciseJSONEncoder, separators=(',', ':'), sort_keys=True)
+
+
+def decode_delta(data, fields):
+    """
+    Decode a delta, converting every value back to a Python value with the
+    field it belongs to. fields maps attnames to fields.
+    """
+    return dict((name, fields[name].to_python(value))
+                for name, value in json.loads(data).items())
+
+
+def walk_back(rows, names, fields, min_id=None):
+    """
+    Rebuild full states from rows of (history_id, history_type,
+    history_delta, *values), ordered from newest to oldest. Rows are only
+    read until a keyframe at or before min_id is found, or the newest row's
+    keyframe when min_id is None.
+
+    Returns a list of (history_id, history_type, values) from oldest to
+    newest, where values is a dictionary of the important fields.
+    """
+    chain = []
+    for row in rows:
+        chain.append(row)
+        if row[2] is None and (min_id is None or row[0] <= min_id):
+            break
+    else:
+        if chain:
+            raise BrokenHistory('No keyframe before historical record %s.' % chain[-1][0])
+        return []
+
+    states = []
+    values = None
+    for row in reversed(chain):
+        history_id, history_type, data = row[:3]
+        if data is None:
+            values = dict(zip(names, row[3:]))
+        else:
+            values = dict(values)
+            values.update(decode_delta(data, fields))
+        states.append((history_id, history_type, values))
+    return states
+
+
+def state_rows(queryset, names):
+    """
+    Return the rows walk_back() expects from a queryset of historical
+    records, newest first.
+    """
+    return queryset.order_by('-history_id') \
+                   .values_list('history_id', 'history_type', 'history_delta', *names) \
+                   .iterator()
+
+
+def rebuild_entries(records, entries, using=None):
+    """
+    Fill in the fields of delta-encoded historical model instances with
+    their full state, using one query for each object they belong to.
+    """
+    names = records.plan.names
+    fields = records.plan.field_map
+    pk_name = records.plan.pk_name
+
+    by_object = {}
+    for entry in entries:
+        if entry.history_delta is not None and not getattr(entry, '_history_rebuilt', False):
+            by_object.setdefault(getattr(entry, pk_name), []).append(entry)
+
+    queryset = records.history_model._base_manager.using(using)
+    for object_pk, object_entries in by_object.items():
+        ids = [entry.history_id for entry in object_entries]
+        rows = state_rows(queryset.filter(**{pk_name: object_pk,
+                                             'history_id__lte': max(ids)}), names)
+        states = dict((history_id, values) for history_id, history_type, values
+                      in walk_back(rows, names, fields, min_id=min(ids)))
+        for entry in object_entries:
+            for name, value in states[entry.history_id].items():
+                setattr(entry, name, value)
+            entry._history_rebuilt = True
@@ -0,0 +1,147 @@
+"""
+Export of historical records to JSON lines or CSV.
+
+    from history.export import export
+    with open('history.jsonl', 'w') as output:
+        count, last_id = export(MyModel, output, after_id=previous_last_id)
+
+Records are read as tuples in chunks, using keyset pagination on the
+object and history_id, and written out without creating any model
+instance. Delta-encoded records are exported with their full state.
+The returned history_id can be given as after_id to the next export, to
+only export the records created since.
+"""
+import csv
+import datetime
+from collections import OrderedDict
+
+from django.db import models
+from django.utils import six
+
+from history.delta import BrokenHistory, PreciseJSONEncoder, decode_delta, state_rows, walk_back
+
+FORMATS = ('jsonl', 'csv')
+COLUMNS = ['history_id', 'history_date', 'history_type', 'history_editor_id']
+
+
+def export(model, output, format='jsonl', after_id=None, object_pk=None, diffs=False,
+           chunk_size=2000, using=None):
+    """
+    Write the historical records of model, or only those of the object
+    with the primary key object_pk, to the file output as JSON lines or CSV.
+    With after_id, only the records with a greater history_id are written.
+    With diffs, every record also has the changes since the previous record
+    of its object, as a dictionary of field names to [old, new] values.
+
+    Returns the number of records written and the greatest history_id, or
+    after_id when there were none.
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown format %r, use one of %s.' % (format, ', '.join(FORMATS)))
+    encoder = PreciseJSONEncoder(separators=(',', ':'))
+    columns = COLUMNS + model._historical_records.plan.names
+    if format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(columns + ['changes'] if diffs else columns)
+
+    count = 0
+    last_id = after_id
+    for values, changes in iter_rows(model, after_id, object_pk, diffs, chunk_size, using):
+        if format == 'jsonl':
+            record = OrderedDict(zip(columns, values))
+            if diffs:
+                record['changes'] = changes
+            output.write(encoder.encode(record) + '\n')
+        else:
+            row = [csv_value(value) for value in values]
+            if diffs:
+                row.append(encoder.encode(changes))
+            writer.writerow(row)
+        count += 1
+        if last_id is None or values[0] > last_id:
+            last_id = values[0]
+    return count, last_id
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    if six.PY2 and isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return value
+
+
+def iter_rows(model, after_id=None, object_pk=None, diffs=False, chunk_size=2000, using=None):
+    """
+    Yield the values of the historical records of model, in the order of
+    COLUMNS followed by the important fields, grouped by object, and their
+    changes as a dictionary of field names to (old, new) when diffs is set.
+    """
+    records = model._historical_records
+    plan = records.plan
+    names = plan.names
+    fields = plan.field_map
+    positions = plan.positions
+    pk_name = plan.pk_name
+    delta = bool(records._keyframe_interval)
+
+    history = records.history_model._base_manager.using(using or records.db_for_read())
+    if object_pk is not None:
+        history = history.filter(**{pk_name: object_pk})
+    columns = list(COLUMNS)
+    if delta:
+        columns.append('history_delta')
+    offset = len(columns)
+    pk_index = offset + positions[pk_name]
+    queryset = history
+    if after_id is not None:
+        queryset = queryset.filter(history_id__gt=after_id)
+    queryset = queryset.order_by(pk_name, 'history_id').values_list(*(columns + names))
+
+    last = previous = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(models.Q(**{'%s__gt' % pk_name: last[0]}) |
+                                 models.Q(**{pk_name: last[0], 'history_id__gt': last[1]}))
+        count = 0
+        for row in chunk[:chunk_size].iterator():
+            count += 1
+            row_pk = row[pk_index]
+            if last is None or last[0] != row_pk:
+                previous = None
+                if after_id is not None and (diffs or (delta and row[4] is not None)):
+                    previous = previous_values(records, history, row_pk, row[0])
+            values = row[offset:]
+            if delta and row[4] is not None:
+                if previous is None:
+                    raise BrokenHistory('No keyframe before historical record %s.' % row[0])
+                values = list(previous)
+                for name, value in decode_delta(row[4], fields).items():
+                    values[positions[name]] = value
+            changes = None
+            if diffs:
+                changes = dict((name, (None if previous is None else previous[i], values[i]))
+                               for i, name in enumerate(names)
+                               if previous is None or previous[i] != values[i])
+            yield list(row[:len(COLUMNS)]) + list(values), changes
+            previous = values
+            last = (row_pk, row[0])
+        if count < chunk_size:
+            return
+
+
+def previous_values(records, history, object_pk, history_id):
+    """
+    Return the values of the important fields of the record of an object
+    before history_id, or None.
+    """
+    names = records.plan.names
+    queryset = history.filter(**{records.plan.pk_name: object_pk, 'history_id__lt': history_id})
+    if records._keyframe_interval:
+        states = walk_back(state_rows(queryset, names), names, records.plan.field_map)
+        return [states[-1][2][name] for name in names] if states else None
+    rows = list(queryset.order_by('-history_id').values_list(*names)[:1])
+    return rows[0] if rows else None
@@ -0,0 +1,105 @@
+"""
+Timings and counters for the capture of historical records.
+
+HistoricalRecords reports these phases, per model:
+- lookup: fetching the most recent historical record to compare with
+- diff: comparing the saved instance with it, or with its snapshot
+- write: creating the historical records (count is the number of records)
+- skipped: a save which didn't change any important field (no duration)
+
+Nothing is measured until a sink is added. A sink is a callable taking
+(model, phase, duration, count), with duration in seconds or None:
+
+    from history.instrumentation import instrumentation, StatsSink
+    stats = StatsSink()
+    instrumentation.add_sink(stats)
+    ...
+    stats.stats['example_app.TestModel']['write']['total']
+"""
+import timeit
+
+from history.signals import history_metric
+
+
+class Instrumentation(object):
+    def __init__(self):
+        self.sinks = []
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def timer(self, model, phase, count=1):
+        """
+        Return a context manager measuring the duration of phase for model.
+        """
+        if not self.sinks:
+            return NULL_TIMER
+        return Timer(self, model, phase, count)
+
+    def emit(self, model, phase, duration=None, count=1):
+        for sink in self.sinks:
+            sink(model, phase, duration, count)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    def __init__(self, instrumentation, model, phase, count):
+        self.instrumentation = instrumentation
+        self.model = model
+        self.phase = phase
+        self.count = count
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = timeit.default_timer() - self.start
+        self.instrumentation.emit(self.model, self.phase, duration, self.count)
+        return False
+
+
+class StatsSink(object):
+    """
+    Collects the metrics in a dictionary:
+    stats[model label][phase] = {'calls': ..., 'count': ..., 'total': ..., 'max': ...}
+    """
+    def __init__(self):
+        self.stats = {}
+
+    def __call__(self, model, phase, duration, count):
+        phases = self.stats.setdefault(model._meta.label, {})
+        stats = phases.get(phase)
+        if stats is None:
+            stats = phases[phase] = {'calls': 0, 'count': 0, 'total': 0.0, 'max': 0.0}
+        stats['calls'] += 1
+        stats['count'] += count
+        if duration is not None:
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+
+    def reset(self):
+        self.stats = {}
+
+
+class SignalSink(object):
+    """
+    Sends the history.signals.history_metric signal for every metric.
+    """
+    def __call__(self, model, phase, duration, count):
+        history_metric.send(sender=model, phase=phase, duration=duration, count=count)
+
+
+instrumentation = Instrumentation()
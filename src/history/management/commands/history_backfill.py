@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from history.backfill import backfill
+from history.utils import get_tracked_models
+
+
+class Command(BaseCommand):
+    help = ('Create a first historical record for the existing objects of tracked models '
+            'which have none.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Tracked models to backfill, all of them by default.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of objects per query.')
+        parser.add_argument('--resume-after', metavar='PK',
+                            help='Start after this primary key, to resume an interrupted run.')
+        parser.add_argument('--database', help='Database alias of the objects.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the records which would be created.')
+
+    def handle(self, **options):
+        self.verbosity = options['verbosity']
+        try:
+            models = get_tracked_models(options['models'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if options['resume_after'] is not None and len(models) != 1:
+            raise CommandError('--resume-after needs a single model.')
+
+        for model in models:
+            objects, created = backfill(model, chunk_size=options['chunk_size'],
+                                        start_after=options['resume_after'],
+                                        using=options['database'], dry_run=options['dry_run'],
+                                        progress=self.progress)
+            self.stdout.write('%s: %d objects, %d records %s.' % (
+                model._meta.label, objects, created,
+                'would be created' if options['dry_run'] else 'created'))
+
+    def progress(self, model, last, objects, created):
+        if self.verbosity > 1:
+            self.stdout.write('%s: %d objects, %d records, last primary key %s' % (
+                model._meta.label, objects, created, last))
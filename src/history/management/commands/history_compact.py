@@ -0,0 +1,58 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from history.retention import PERIODS, compact
+from history.utils import get_tracked_models
+
+
+class Command(BaseCommand):
+    help = ('Delete old historical records, keeping the most recent record of every '
+            'object and the records of deletions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Tracked models to compact, all of them by default.')
+        parser.add_argument('--keep-last', type=int,
+                            help='Keep this many records per object.')
+        parser.add_argument('--thin', choices=sorted(PERIODS),
+                            help='Keep the most recent record of every period.')
+        parser.add_argument('--older-than', type=int, metavar='DAYS',
+                            help='Only delete records older than this many days.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of objects, and of deleted records, per query.')
+        parser.add_argument('--resume-after', metavar='PK',
+                            help='Start after this primary key, to resume an interrupted run.')
+        parser.add_argument('--database', help='Database alias of the historical records.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the records which would be deleted.')
+
+    def handle(self, **options):
+        self.verbosity = options['verbosity']
+        if options['keep_last'] is None and options['thin'] is None and options['older_than'] is None:
+            raise CommandError('Give at least one of --keep-last, --thin and --older-than.')
+        try:
+            models = get_tracked_models(options['models'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if options['resume_after'] is not None and len(models) != 1:
+            raise CommandError('--resume-after needs a single model.')
+        before = None
+        if options['older_than'] is not None:
+            before = timezone.now() - datetime.timedelta(days=options['older_than'])
+
+        for model in models:
+            objects, deleted = compact(model, keep_last=options['keep_last'], thin=options['thin'],
+                                       before=before, chunk_size=options['chunk_size'],
+                                       start_after=options['resume_after'],
+                                       using=options['database'], dry_run=options['dry_run'],
+                                       progress=self.progress)
+            self.stdout.write('%s: %d objects, %d records %s.' % (
+                model._meta.label, objects, deleted,
+                'would be deleted' if options['dry_run'] else 'deleted'))
+
+    def progress(self, model, last, objects, deleted):
+        if self.verbosity > 1:
+            self.stdout.write('%s: %d objects, %d records, last primary key %s' % (
+                model._meta.label, objects, deleted, last))
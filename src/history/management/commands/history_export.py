@@ -0,0 +1,56 @@
+import gzip
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+
+from history.export import FORMATS, export
+from history.utils import get_tracked_models
+
+
+class Command(BaseCommand):
+    help = ('Write the historical records of a tracked model as JSON lines or CSV. The '
+            'last history_id is reported, to be given as --after-id to the next export.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', metavar='app_label.ModelName', help='Tracked model to export.')
+        parser.add_argument('--format', choices=FORMATS, default='jsonl')
+        parser.add_argument('--output', help='File to write to, instead of stdout.')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip.')
+        parser.add_argument('--after-id', type=int,
+                            help='Only export the records with a greater history_id.')
+        parser.add_argument('--object', metavar='PK', help='Only export the records of this object.')
+        parser.add_argument('--diffs', action='store_true',
+                            help='Add the changes since the previous record of every record.')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of records per query.')
+        parser.add_argument('--database', help='Database alias of the historical records.')
+
+    def handle(self, **options):
+        try:
+            model, = get_tracked_models([options['model']])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        binary = six.PY2 or options['gzip']
+        if options['output']:
+            stream = open(options['output'], 'wb') if binary else io.open(options['output'], 'w', newline='')
+        else:
+            stream = getattr(sys.stdout, 'buffer', sys.stdout) if binary else sys.stdout
+        output = stream
+        if options['gzip']:
+            output = gzip.GzipFile(fileobj=stream, mode='wb')
+            if six.PY3:
+                output = io.TextIOWrapper(output, encoding='utf-8', newline='')
+        try:
+            count, last_id = export(model, output, format=options['format'],
+                                    after_id=options['after_id'], object_pk=options['object'],
+                                    diffs=options['diffs'], chunk_size=options['chunk_size'],
+                                    using=options['database'])
+        finally:
+            if output is not stream:
+                output.close()
+            if options['output']:
+                stream.close()
+        self.stderr.write('%s: %d records, last history_id %s.' % (model._meta.label, count, last_id))
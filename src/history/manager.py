@@ -1,30 +1,168 @@
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.expressions import Exists, OuterRef, Subquery
+from django.db.models.query import ModelIterable
+
+from history.changes import HistoryChange, HistoryPage, HistoryRevision
+from history.delta import BrokenHistory, decode_delta, rebuild_entries, state_rows, walk_back
 
 
 class HistoryDescriptor(object):
-    def __init__(self, model, important_fields):
+    def __init__(self, model, plan):
         self.model = model
-        self.important_fields = important_fields
+        self.plan = plan
 
     def __get__(self, instance, owner):
         if instance is None:
-            return HistoryManager(self.model, self.important_fields)
-        return HistoryManager(self.model, self.important_fields, instance)
+            return HistoryManager(self.model, self.plan, original_model=owner)
+        return HistoryManager(self.model, self.plan, instance)
+
+
+class HistoryQuerySet(models.QuerySet):
+    _with_changes = False
+
+    def with_changes(self):
+        """
+        Fetch the previous entry of every historical record together with
+        the records, so that previous_entry and modified_fields don't need
+        a query for each record.
+        """
+        pk_name = self.model._historical_records.model._meta.pk.name
+        previous = self.model._base_manager.filter(**{
+            pk_name: OuterRef(pk_name),
+            'history_id__lt': OuterRef('history_id'),
+        }).order_by('-history_id').values('history_id')[:1]
+        clone = self.annotate(previous_history_id=Subquery(previous))
+        clone._with_changes = True
+        return clone
+
+    def page(self, before_id=None, limit=50):
+        """
+        Return a HistoryPage with up to limit records, newest first, older
+        than the record with the history_id before_id. Unlike slicing with
+        an offset, this uses the index on history_id whatever the page.
+        """
+        queryset = self.order_by('-history_id')
+        if before_id is not None:
+            queryset = queryset.filter(history_id__lt=before_id)
+        entries = list(queryset[:limit + 1])
+        if len(entries) > limit:
+            entries = entries[:limit]
+            return HistoryPage(entries, entries[-1].history_id)
+        return HistoryPage(entries, None)
+
+    def _clone(self, *args, **kwargs):
+        clone = super(HistoryQuerySet, self)._clone(*args, **kwargs)
+        clone._with_changes = self._with_changes
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(HistoryQuerySet, self)._fetch_all()
+        if not fetched or self._iterable_class is not ModelIterable:
+            return
+        self._complete(self._result_cache)
+
+    def iterator(self, chunk_size=500):
+        """
+        Like QuerySet.iterator(), also rebuilding delta-encoded records and
+        attaching previous entries, like _fetch_all(), for every chunk of
+        chunk_size records.
+        """
+        records = self.model._historical_records
+        entries = super(HistoryQuerySet, self).iterator()
+        if self._iterable_class is not ModelIterable or \
+           not (records._keyframe_interval or self._with_changes):
+            for entry in entries:
+                yield entry
+            return
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) == chunk_size:
+                for entry in self._complete(chunk):
+                    yield entry
+                chunk = []
+        for entry in self._complete(chunk):
+            yield entry
+
+    def _complete(self, entries):
+        records = self.model._historical_records
+        if records._keyframe_interval:
+            rebuild_entries(records, entries, self.db)
+        if self._with_changes:
+            self._attach_previous_entries(entries)
+        return entries
+
+    def _attach_previous_entries(self, entries, chunk_size=500):
+        by_id = dict((entry.history_id, entry) for entry in entries)
+        missing = list(set(entry.previous_history_id for entry in entries
+                           if entry.previous_history_id is not None and
+                           entry.previous_history_id not in by_id))
+        queryset = self.model._base_manager.using(self.db)
+        previous = []
+        for start in range(0, len(missing), chunk_size):
+            previous.extend(queryset.filter(history_id__in=missing[start:start + chunk_size]))
+        records = self.model._historical_records
+        if records._keyframe_interval:
+            rebuild_entries(records, previous, self.db)
+        for entry in previous:
+            by_id[entry.history_id] = entry
+        for entry in entries:
+            entry._previous_entry = by_id.get(entry.previous_history_id)
 
 
-class HistoryManager(models.Manager):
-    def __init__(self, model, important_fields, instance=None):
+class HistoryManager(models.Manager.from_queryset(HistoryQuerySet)):
+    def __init__(self, model, plan, instance=None, original_model=None):
         super(HistoryManager, self).__init__()
         self.model = model
         self.instance = instance
-        self.important_fields = important_fields
+        self.plan = plan
+        self.important_fields = plan.names
+        self.original_model = original_model or instance.__class__
 
     def get_queryset(self):
         if self.instance is None:
-            return super(HistoryManager, self).get_queryset()
+            return self._history_queryset()
 
         filter = {self.instance._meta.pk.name: self.instance.pk}
-        return super(HistoryManager, self).get_queryset().filter(**filter)
+        return self._history_queryset().filter(**filter)
+
+    def _history_queryset(self):
+        """
+        All the historical records, from the read_using database of the
+        HistoricalRecords unless db_manager() chose another one.
+        """
+        queryset = super(HistoryManager, self).get_queryset()
+        if self._db is None:
+            read_using = self.model._historical_records.db_for_read()
+            if read_using is not None:
+                queryset = queryset.using(read_using)
+        return queryset
+
+    def page(self, before_id=None, limit=50):
+        """
+        Like HistoryQuerySet.page(), also setting the total of the page for
+        an instance, see count_versions().
+        """
+        page = self.get_queryset().page(before_id, limit)
+        if self.instance is not None:
+            page.total = self.count_versions()
+        return page
+
+    def count_versions(self):
+        """
+        Return the number of historical records of the instance. With
+        HistoricalRecords(versioned=True), this is the history_version of
+        the most recent one, which needs no COUNT, and which compact()
+        lowers to the number of records it leaves.
+        """
+        if self.model._historical_records._versioned:
+            versions = list(self.values_list('history_version', flat=True)[:1])
+            if not versions:
+                return 0
+            if versions[0] is not None:
+                return versions[0]
+        return self.count()
 
     def most_recent(self):
         """
@@ -33,24 +171,42 @@ class HistoryManager(models.Manager):
         if not self.instance:
             raise TypeError("Can't use most_recent() without a %s instance." % \
                             self.instance._meta.object_name)
-        #fields = (field.name for field in self.instance._meta.fields)
-        fields = self.important_fields
+        if self.model._historical_records._keyframe_interval:
+            states = self._rebuild(self.all())
+            if not states:
+                raise self.instance.DoesNotExist("%s has no historical record." % \
+                                                 self.instance._meta.object_name)
+            return self._build(states[-1][2])
         try:
-            values = self.values_list(*fields)[0]
+            values = self.values_list(*self.plan.names)[0]
         except IndexError:
             raise self.instance.DoesNotExist("%s has no historical record." % \
                                              self.instance._meta.object_name)
-        return self.instance.__class__(*values)
+        return self.plan.build(values, self.original_model)
 
-    def as_of(self, date):
+    def as_of(self, date, queryset=None):
         """
         Returns an instance of the original model with all the attributes set
         according to what was present on the object on the date provided.
+
+        Without an instance, returns an iterator over the instances of all
+        the objects which existed on that date, or only those of queryset,
+        using a single query.
         """
         if not self.instance:
-            raise TypeError("Can't use as_of() without a %s instance." % \
-                            self.instance._meta.object_name)
-        fields = (field.name for field in self.instance._meta.fields)
+            return self.all_as_of(date, queryset)
+        if self.model._historical_records._cache is not None:
+            return self._cached_as_of(date)
+        if self.model._historical_records._keyframe_interval:
+            states = self._rebuild(self.filter(history_date__lte=date))
+            if not states:
+                raise self.instance.DoesNotExist("%s had not yet been created." % \
+                                                 self.instance._meta.object_name)
+            if states[-1][1] == '-':
+                raise self.instance.DoesNotExist("%s had already been deleted." % \
+                                                 self.instance._meta.object_name)
+            return self._build(states[-1][2])
+        fields = self.plan.names
         qs = self.filter(history_date__lte=date)
         try:
             values = qs.values_list('history_type', *fields)[0]
@@ -60,4 +216,249 @@ class HistoryManager(models.Manager):
         if values[0] == '-':
             raise self.instance.DoesNotExist("%s had already been deleted." % \
                                              self.instance._meta.object_name)
-        return self.instance.__class__(*values[1:])
+        return self.plan.build(values[1:], self.original_model)
+
+    def _cached_as_of(self, date):
+        """
+        as_of() for an instance, finding the history_id of the date first
+        and looking up the values of that record in the cache.
+        """
+        records = self.model._historical_records
+        cache = records._cache
+        rows = self.filter(history_date__lte=date)
+        if records._coalesce_seconds:
+            # The most recent record of the object may still be updated,
+            # by another process too, so it isn't cached.
+            pk_name = self.plan.pk_name
+            newer = self.model._base_manager.filter(**{pk_name: OuterRef(pk_name),
+                                                       'history_id__gt': OuterRef('history_id')})
+            rows = rows.annotate(newer=Exists(newer)).values_list('history_id', 'history_type', 'newer')
+        else:
+            rows = rows.values_list('history_id', 'history_type')
+        rows = list(rows[:1])
+        if not rows:
+            raise self.instance.DoesNotExist("%s had not yet been created." % \
+                                             self.instance._meta.object_name)
+        history_id, history_type = rows[0][:2]
+        cacheable = not records._coalesce_seconds or rows[0][2]
+        if history_type == '-':
+            raise self.instance.DoesNotExist("%s had already been deleted." % \
+                                             self.instance._meta.object_name)
+        values = cache.get(self.model, self.instance.pk, history_id) if cacheable else None
+        if values is None:
+            if self.model._historical_records._keyframe_interval:
+                states = self._rebuild(self.filter(history_id__lte=history_id))
+                values = tuple(states[-1][2][name] for name in self.plan.names)
+            else:
+                values = self.filter(history_id=history_id).values_list(*self.plan.names)[0]
+            if cacheable:
+                cache.set(self.model, self.instance.pk, history_id, values)
+        return self.plan.build(values, self.original_model)
+
+    def all_as_of(self, date, queryset=None, chunk_size=500):
+        """
+        Yields an instance of the original model for every object, or every
+        object in queryset, as it was on the date provided. Objects which
+        had not been created yet or had already been deleted are left out.
+
+        With delta-encoded records, objects whose record on that date is not
+        a keyframe need one more query each.
+        """
+        pk_name = self.original_model._meta.pk.name
+        history = self._history_queryset()
+        if queryset is not None:
+            history = history.filter(**{'%s__in' % pk_name: queryset.values('pk')})
+        latest = history.filter(history_date__lte=date).order_by() \
+                        .values(pk_name).annotate(latest_id=models.Max('history_id')) \
+                        .values('latest_id')
+        rows = history.filter(history_id__in=latest).exclude(history_type='-') \
+                      .order_by(pk_name)
+        if self.model._historical_records._keyframe_interval:
+            for values in self._rebuild_latest(rows, chunk_size):
+                yield self.plan.build(values, self.original_model)
+            return
+        for values in rows.values_list(*self.plan.names).iterator():
+            yield self.plan.build(values, self.original_model)
+
+    def iter_changes(self, chunk_size=2000):
+        """
+        Yields a HistoryRevision with the changes of every historical record,
+        oldest first, without creating any model instance. Without an
+        instance, the records are grouped by object.
+
+        Records are read as tuples in chunks of chunk_size, using keyset
+        pagination on the object and history_id, so memory use doesn't
+        depend on the length of the history.
+        """
+        plan = self.plan
+        names = plan.names
+        fields = plan.field_map
+        verbose_names = [plan.verbose_names[name] for name in names]
+        positions = plan.positions
+        pk_name = plan.pk_name
+        delta = bool(self.model._historical_records._keyframe_interval)
+
+        columns = ['history_id', 'history_date', 'history_type', 'history_editor_id']
+        if delta:
+            columns.append('history_delta')
+        offset = len(columns)
+        pk_index = offset + positions[pk_name]
+        queryset = self.get_queryset().order_by(pk_name, 'history_id') \
+                                      .values_list(*(columns + names))
+
+        last = previous = None
+        while True:
+            chunk = queryset
+            if last is not None:
+                chunk = chunk.filter(models.Q(**{'%s__gt' % pk_name: last[0]}) |
+                                     models.Q(**{pk_name: last[0], 'history_id__gt': last[1]}))
+            count = 0
+            for row in chunk[:chunk_size].iterator():
+                count += 1
+                object_pk = row[pk_index]
+                if last is not None and last[0] != object_pk:
+                    previous = None
+                values = row[offset:]
+                if delta and row[4] is not None:
+                    if previous is None:
+                        raise BrokenHistory('No keyframe before historical record %s.' % row[0])
+                    values = list(previous)
+                    for name, value in decode_delta(row[4], fields).items():
+                        values[positions[name]] = value
+                if previous is None:
+                    changes = [HistoryChange(name, None, values[i], verbose_names[i])
+                               for i, name in enumerate(names)]
+                else:
+                    changes = [HistoryChange(name, previous[i], values[i], verbose_names[i])
+                               for i, name in enumerate(names) if previous[i] != values[i]]
+                yield HistoryRevision(row[0], row[1], row[2], row[3], object_pk, changes)
+                previous = values
+                last = (object_pk, row[0])
+            if count < chunk_size:
+                return
+
+    def _rebuild(self, queryset):
+        """
+        Rebuild the full states of the newest record of a delta-encoded
+        queryset, reading its last keyframe and the deltas after it.
+        """
+        names = self.plan.names
+        return walk_back(state_rows(queryset, names), names, self.plan.field_map)
+
+    def _build(self, values):
+        """
+        Create an instance of the original model from a dictionary of values.
+        """
+        return self.plan.build([values[name] for name in self.plan.names], self.original_model)
+
+    def _rebuild_latest(self, rows, chunk_size):
+        """
+        Yield the values of every record of rows, rebuilding delta-encoded
+        ones with one query per object, for chunks of chunk_size records.
+        """
+        for entry in rows.iterator(chunk_size):
+            yield self.plan.values(entry)
+
+
+class TrackedQuerySet(models.QuerySet):
+    """
+    QuerySet for a model with HistoricalRecords, which also creates the
+    historical records for bulk_create(), update(), bulk_update() and
+    delete(), using one bulk_create() on the historical model per chunk.
+
+    Usage:
+    class MyModel(models.Model):
+        ...
+        objects = TrackedManager()
+        history = HistoricalRecords()
+    """
+    def bulk_create(self, objs, batch_size=None, editor=None):
+        records = self.model._historical_records
+        objs = list(objs)
+        connection = connections[self.db]
+        with transaction.atomic(using=self.db, savepoint=False):
+            if getattr(connection.features, 'can_return_ids_from_bulk_insert', False):
+                super(TrackedQuerySet, self).bulk_create(objs, batch_size=batch_size)
+            else:
+                # The historical records need the primary keys, so objects
+                # without one are inserted one by one on this backend.
+                with_pk = [obj for obj in objs if obj.pk is not None]
+                without_pk = [obj for obj in objs if obj.pk is None]
+                super(TrackedQuerySet, self).bulk_create(with_pk, batch_size=batch_size)
+                fields = [f for f in self.model._meta.concrete_fields
+                          if not isinstance(f, models.AutoField)]
+                for obj in without_pk:
+                    obj.pk = self._insert([obj], fields=fields, return_id=True)
+                    obj._state.adding = False
+                    obj._state.db = self.db
+            records.create_historical_records(
+                [records.get_historical_attrs(obj) for obj in objs], editor, '+', self.db)
+        if records._track_state:
+            for obj in objs:
+                obj._history_snapshot = records.get_snapshot(obj)
+        return objs
+
+    def update(self, **kwargs):
+        records = self.model._historical_records
+        editor = kwargs.pop('editor', None)
+        if not self._tracks_any(kwargs):
+            return super(TrackedQuerySet, self).update(**kwargs)
+        assert self.query.can_filter(), "Cannot update a query once a slice has been taken."
+        with transaction.atomic(using=self.db, savepoint=False):
+            pks = list(self.values_list('pk', flat=True))
+            # Only the rows which were read, others may match the filters
+            # by now.
+            queryset = self.model._base_manager.using(self.db)
+            rows = 0
+            chunk_size = 1000
+            for start in range(0, len(pks), chunk_size):
+                rows += queryset.filter(pk__in=pks[start:start + chunk_size]).update(**kwargs)
+            records.create_historical_records_for_pks(self.model, pks, editor, '~', using=self.db)
+        return rows
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None, editor=None):
+        records = self.model._historical_records
+        objs = list(objs)
+        fields = [self.model._meta.get_field(name) for name in fields]
+        with transaction.atomic(using=self.db, savepoint=False):
+            if hasattr(models.QuerySet, 'bulk_update'):
+                super(TrackedQuerySet, self).bulk_update(
+                    objs, [f.name for f in fields], batch_size=batch_size)
+            else:
+                queryset = self.model._base_manager.using(self.db)
+                for obj in objs:
+                    values = dict((f.attname, getattr(obj, f.attname)) for f in fields)
+                    queryset.filter(pk=obj.pk).update(**values)
+            if self._tracks_any(f.attname for f in fields):
+                pks = [obj.pk for obj in objs]
+                records.create_historical_records_for_pks(self.model, pks, editor, '~', using=self.db)
+        if records._track_state:
+            for obj in objs:
+                obj._history_snapshot = records.get_snapshot(obj)
+    bulk_update.alters_data = True
+
+    def delete(self):
+        records = self.model._historical_records
+        with transaction.atomic(using=self.db, savepoint=False):
+            with records.collect_deleted() as deleted:
+                result = super(TrackedQuerySet, self).delete()
+            records.create_historical_records(deleted, None, '-', self.db)
+        return result
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _tracks_any(self, names):
+        """
+        Return True when one of the given field names or attnames is saved
+        in the historical records.
+        """
+        important = self.model._historical_records.plan.field_map
+        for name in names:
+            if self.model._meta.get_field(name).attname in important:
+                return True
+        return False
+
+
+class TrackedManager(models.Manager.from_queryset(TrackedQuerySet)):
+    pass
@@ -1,24 +1,22 @@
 import copy
 import datetime
+import threading
 
-from django.db import models
+from contextlib import contextmanager
+from django.db import models, router
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.base import ModelBase
 from django.utils import timezone
 from functools import wraps
 
 from history import manager
-
-
-class HistoryChange(object):
-    def __init__(self, name, from_value, to_value, verbose_name):
-        self.name = name
-        self.from_value = from_value
-        self.to_value = to_value
-        self.verbose_name = verbose_name
-
-    def __unicode__(self):
-        return 'Field "%s" changed from "%s" to "%s"' % (self.name, self.from_value, self.to_value)
+from history.buffer import buffer
+from history.changes import HistoryChange
+from history.instrumentation import instrumentation as default_instrumentation
+from history.delta import BrokenHistory, encode_delta, rebuild_entries, state_rows, walk_back
+from history.plan import FieldPlan
+from history.writers import save_records
 
 
 class HistoricalRecords(object):
@@ -34,17 +32,88 @@ class HistoricalRecords(object):
                          migrations, and table names.)
     - (optional) fields: a list of field names to be checked and saved. If
                          nothing is defined, all fields will be saved.
+    - (optional) track_state: keep a snapshot of the important fields on
+                         every instance when it is loaded or saved, and
+                         compare against it instead of fetching the most
+                         recent historical record on every save.
+    - (optional) buffered: gather the historical records created inside a
+                         transaction, and write them with one bulk_create()
+                         when it commits. Consecutive changes of the same
+                         object are collapsed into one record.
+    - (optional) indexes: extra indexes for the historical model, as tuples
+                         of field names or models.Index instances. The
+                         primary key of the object is always indexed
+                         together with history_id and history_date.
+    - (optional) keyframe_interval: only save the fields which changed for
+                         a change, and a full copy of all fields every
+                         keyframe_interval records. See history.delta.
+    - (optional) writer: the object which saves the historical records, like
+                         history.writers.QueuedWriter. By default they are
+                         saved right away.
+    - (optional) instrumentation: the history.instrumentation.Instrumentation
+                         which receives the timings and counters of the
+                         capture. By default, the shared one in that module.
+    - (optional) fingerprint: save a hash of the important fields in a
+                         history_fingerprint column, so that saves only
+                         fetch that hash to check whether anything changed.
+    - (optional) using: the database alias the historical records are
+                         written to. Foreign keys of the historical model
+                         then have no database constraint.
+    - (optional) read_using: the database alias the history manager reads
+                         from, like a replica of using. Defaults to using.
+                         See also history.routers.HistoryRouter.
+    - (optional) coalesce_seconds: update the most recent historical record
+                         of an object instead of creating a new one, when
+                         both are changes and it is less than this many
+                         seconds old. Creations and deletions always get
+                         their own record.
+    - (optional) versioned: number the historical records of every object in
+                         a history_version column, so that counting them
+                         only needs the most recent one.
+    - (optional) cache: a cache for the states rebuilt by as_of(), like
+                         history.cache.LocMemSnapshotCache. See history.cache.
     """
-    def __init__(self, module=None, fields=None):
+    def __init__(self, module=None, fields=None, track_state=False, buffered=False,
+                 indexes=(), keyframe_interval=None, writer=None, instrumentation=None,
+                 fingerprint=False, using=None, read_using=None, coalesce_seconds=None,
+                 versioned=False, cache=None):
+        if keyframe_interval and writer is not None:
+            raise ImproperlyConfigured('Delta-encoded historical records need the previous '
+                                       'record to be saved, so they cannot use a writer.')
+        if coalesce_seconds and (buffered or writer is not None):
+            raise ImproperlyConfigured('Coalesced historical records update the previous '
+                                       'record right away, so they cannot be buffered or '
+                                       'use a writer.')
+        if versioned and (buffered or writer is not None):
+            raise ImproperlyConfigured('Versioned historical records need the previous record '
+                                       'to be saved, so they cannot be buffered or use a writer.')
         self._module = module
         self._fields = fields
+        self._track_state = track_state
+        self._buffered = buffered
+        self._indexes = indexes
+        self._keyframe_interval = keyframe_interval
+        self._writer = writer
+        self._instrumentation = instrumentation or default_instrumentation
+        self._fingerprint = fingerprint
+        self._using = using
+        self._read_using = read_using
+        self._coalesce_seconds = coalesce_seconds
+        self._versioned = versioned
+        self._cache = cache
+        self._local = threading.local()
 
     def contribute_to_class(self, cls, name):
         self.manager_name = name
         models.signals.class_prepared.connect(self.finalize, sender=cls)
 
     def finalize(self, sender, **kwargs):
+        self.model = sender
+        self.plan = FieldPlan(sender, self.get_important_fields(sender))
         history_model = self.create_history_model(sender)
+        self.history_model = history_model
+        sender._historical_records = self
+        history_model._historical_records = self
 
         # The HistoricalRecords object will be discarded,
         # so the signal handlers can't use weak references.
@@ -52,8 +121,12 @@ class HistoricalRecords(object):
                                          weak=False)
         models.signals.post_delete.connect(self.post_delete, sender=sender,
                                            weak=False)
+        if self._track_state:
+            models.signals.post_init.connect(self.post_init, sender=sender,
+                                             weak=False)
+            self.capture_refresh_method(sender)
 
-        descriptor = manager.HistoryDescriptor(history_model, self.get_important_field_names(sender))
+        descriptor = manager.HistoryDescriptor(history_model, self.plan)
         setattr(sender, self.manager_name, descriptor)
         self.capture_save_method(sender)
         self.create_set_editor_method(sender)
@@ -63,15 +136,39 @@ class HistoricalRecords(object):
         Replace 'save()' by 'save(editor=user)'
         """
         original_save = sender.save
+        track_state = self._track_state
 
         @wraps(original_save)
         def new_save(self, *args, **kwargs):
             # Save editor in temporary variable, post_save will read this one
             self._history_editor = kwargs.pop('editor', getattr(self, '_history_editor', None))
+            if track_state and self._state.adding:
+                # The snapshot taken in post_init only reflects the database
+                # when the instance was loaded from it or saved before.
+                self._history_snapshot = None
             original_save(self, *args, **kwargs)
 
         sender.save = new_save
 
+    def capture_refresh_method(self, sender):
+        """
+        Take the snapshot again after 'refresh_from_db()', which loads the
+        values of the database without calling post_init.
+        """
+        original_refresh_from_db = sender.refresh_from_db
+        get_snapshot = self.get_snapshot
+
+        @wraps(original_refresh_from_db)
+        def new_refresh_from_db(self, using=None, fields=None, **kwargs):
+            original_refresh_from_db(self, using=using, fields=fields, **kwargs)
+            if fields is None:
+                self._history_snapshot = get_snapshot(self)
+            else:
+                # The other fields may have been changed since the snapshot.
+                self._history_snapshot = None
+
+        sender.refresh_from_db = new_refresh_from_db
+
     def create_set_editor_method(self, sender):
         """
         Add a set_editor method to the model which has a history.
@@ -92,12 +189,9 @@ class HistoricalRecords(object):
         """
         rel_nm = '_%s_history' % model._meta.object_name.lower()
         rel_nm_user = '_%s_history_editor' % model._meta.object_name.lower()
-        important_field_names = self.get_important_field_names(model)
-
-        def get_verbose_name(model, field_name):
-            for f in model._meta.fields:
-                if f.name == field_name:
-                    return f.verbose_name
+        plan = self.plan
+        important_field_names = plan.names
+        verbose_names = plan.verbose_names
 
         class HistoryEntryMeta(ModelBase):
             """
@@ -114,6 +208,14 @@ class HistoricalRecords(object):
                 # Copy attributes from base class
                 attrs.update(self.copy_fields(model))
                 attrs.update(Meta=type('Meta', (), self.get_meta_options(model)))
+                if self._keyframe_interval:
+                    attrs['history_delta'] = models.TextField(null=True, blank=True, editable=False)
+                if self._versioned:
+                    attrs['history_version'] = models.PositiveIntegerField(null=True, blank=True,
+                                                                           editable=False)
+                if self._fingerprint:
+                    attrs['history_fingerprint'] = models.CharField(max_length=40, null=True, blank=True,
+                                                                    editable=False)
 
                 return ModelBase.__new__(c, name, bases, attrs)
 
@@ -130,20 +232,34 @@ class HistoricalRecords(object):
                     ('~', 'Changed'),
                     ('-', 'Deleted'),
                 ))
-            history_object = HistoricalObjectDescriptor(model, self.get_important_field_names(model))
+            history_object = HistoricalObjectDescriptor(model, plan)
             history_editor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True,
-                                               related_name=rel_nm_user)
+                                               related_name=rel_nm_user, db_constraint=not self._using)
 
             def __unicode__(self):
                 return u'%s as of %s' % (self.history_object, self.history_date)
 
             @property
             def previous_entry(self):
+                # Set by HistoryQuerySet.with_changes()
+                if '_previous_entry' in self.__dict__:
+                    return self._previous_entry
                 try:
                     return self.history_object.history.order_by('-history_id').filter(history_id__lt=self.history_id)[0]
                 except IndexError:
                     return None
 
+            def same_state_as(self, other):
+                """
+                Return True when this entry and other hold the same values,
+                comparing their fingerprints when both have one.
+                """
+                fingerprints = (getattr(self, 'history_fingerprint', None),
+                                getattr(other, 'history_fingerprint', None))
+                if None not in fingerprints:
+                    return fingerprints[0] == fingerprints[1]
+                return plan.values(self) == plan.values(other)
+
             @property
             def modified_fields(self):
                 """
@@ -151,23 +267,26 @@ class HistoricalRecords(object):
                 """
                 previous_entry = self.previous_entry
                 if previous_entry:
+                    fingerprint = getattr(self, 'history_fingerprint', None)
+                    if fingerprint is not None and fingerprint == previous_entry.history_fingerprint:
+                        return []
                     modified = []
                     for field in important_field_names:
                         from_value = getattr(previous_entry, field)
                         to_value = getattr(self, field)
                         if from_value != to_value:
-                            modified.append(HistoryChange(field, from_value, to_value, get_verbose_name(model, field)))
+                            modified.append(HistoryChange(field, from_value, to_value, verbose_names[field]))
                     return modified
                 else:
                     # No previous history entry, so actually everything has been modified.
-                    return [ HistoryChange(f, None, getattr(self, f), get_verbose_name(model, f)) for f in important_field_names ]
+                    return [ HistoryChange(f, None, getattr(self, f), verbose_names[f]) for f in important_field_names ]
 
         return HistoryEntry
 
     def get_important_fields(self, model):
         """ Return the list of fields that we care about.  """
         for f in model._meta.fields:
-            if f.name == 'id' or not self._fields or f.name in self._fields:
+            if f.primary_key or not self._fields or f.name in self._fields:
                 yield f
 
     def get_important_field_names(self, model):
@@ -192,9 +311,11 @@ class HistoricalRecords(object):
             if field.primary_key or field.unique:
                 # Unique fields can no longer be guaranteed unique,
                 # but they should still be indexed for faster lookups.
+                # The primary key is covered by the composite indexes
+                # from get_meta_options().
+                field.db_index = not field.primary_key
                 field.primary_key = False
                 field._unique = False
-                field.db_index = True
 
             if isinstance(field, models.ForeignKey):
                 # Do not use a related name for foreign keys, or it will clash with the
@@ -209,6 +330,16 @@ class HistoricalRecords(object):
                 field = models.ForeignKey(to=field.rel.to, on_delete=models.CASCADE, related_name="+", null=True,
                                           blank=True)
 
+            if isinstance(field, models.ForeignKey) and self._using:
+                # The related table may live in another database.
+                field.db_constraint = False
+
+            if self._keyframe_interval and field_name != model._meta.pk.name:
+                # Delta-encoded records leave the columns of the fields empty.
+                field.null = True
+                if isinstance(field, models.BooleanField):
+                    field.__class__ = models.NullBooleanField
+
             fields[field_name] = field
 
         return fields
@@ -218,10 +349,25 @@ class HistoricalRecords(object):
         Returns a dictionary of fields that will be added to
         the Meta inner class of the historical record model.
         """
-        return {
+        pk_name = model._meta.pk.name
+        index_together = [
+            (pk_name, 'history_id'),    # most_recent(), previous_entry
+            (pk_name, 'history_date'),  # as_of()
+        ]
+        indexes = []
+        for index in self._indexes:
+            if isinstance(index, (list, tuple)):
+                index_together.append(tuple(index))
+            else:
+                indexes.append(index)
+        options = {
             'ordering': ('-history_id',),
-            'get_latest_by': 'history_id'
+            'get_latest_by': 'history_id',
+            'index_together': index_together,
         }
+        if indexes:
+            options['indexes'] = indexes
+        return options
 
     def post_save(self, instance, created, **kwargs):
         """
@@ -233,36 +379,278 @@ class HistoricalRecords(object):
         # (for example from a fixture) and we don't want to execute this hook.
         if 'raw' in kwargs and kwargs['raw']:
             return
+        timer = self._instrumentation.timer
         # Decide whether to save a history copy: only when certain fields were changed.
         save = True
-        try:
-            most_recent = instance.history.most_recent()
-            save = False
-            for field in self.get_important_field_names(instance):
-                if getattr(instance, field) != getattr(most_recent, field):
-                    save = True
-        except instance.DoesNotExist, e:
-            pass
+        fingerprint = None
+        snapshot = getattr(instance, '_history_snapshot', None)
+        if snapshot is not None:
+            with timer(self.model, 'diff'):
+                save = snapshot != self.get_snapshot(instance)
+        elif not (created and self._track_state):
+            with timer(self.model, 'lookup'):
+                previous = self.get_previous_state(instance)
+            if previous is not None:
+                with timer(self.model, 'diff'):
+                    if self._fingerprint:
+                        fingerprint = self.plan.fingerprint(self.plan.values(instance))
+                        save = previous != fingerprint
+                    else:
+                        save = previous != self.plan.values(instance)
 
         # Create historical record
         if save:
-            self.create_historical_record(instance, instance._history_editor, created and '+' or '~')
+            with timer(self.model, 'write'):
+                self.create_historical_record(instance, instance._history_editor, created and '+' or '~',
+                                              fingerprint)
+        else:
+            self._instrumentation.emit(self.model, 'skipped')
+
+        if self._track_state:
+            instance._history_snapshot = self.get_snapshot(instance)
+
+    def get_previous_state(self, instance):
+        """
+        Return what post_save() compares instance with, or None when it has
+        no history yet: the fingerprint of its most recent historical record
+        with fingerprints, the values of its fields otherwise.
+        """
+        most_recent = self.get_pending_record(instance)
+        # Not from read_using, which may lag behind.
+        manager = getattr(instance, self.manager_name).db_manager(self.db_for_write())
+        if most_recent is None and self._fingerprint:
+            fingerprints = list(manager.values_list('history_fingerprint', flat=True)[:1])
+            if not fingerprints:
+                return None
+            if fingerprints[0] is not None:
+                return fingerprints[0]
+            # Saved before fingerprints were enabled.
+        if most_recent is None:
+            try:
+                most_recent = manager.most_recent()
+            except instance.DoesNotExist:
+                return None
+        values = self.plan.values(most_recent)
+        if self._fingerprint:
+            return self.plan.fingerprint(values)
+        return values
+
+    def post_init(self, instance, **kwargs):
+        instance._history_snapshot = self.get_snapshot(instance)
+
+    def get_snapshot(self, instance):
+        """
+        Return a tuple with the values of the important fields of instance,
+        or None when some of them are deferred and would need a query.
+        """
+        return self.plan.snapshot(instance)
 
     def post_delete(self, instance, **kwargs):
-        self.create_historical_record(instance, None, '-')
+        deleted = getattr(self._local, 'deleted', None)
+        if deleted is not None:
+            deleted.append(self.get_historical_attrs(instance))
+            return
+        with self._instrumentation.timer(self.model, 'write'):
+            self.create_historical_record(instance, None, '-')
 
-    def create_historical_record(self, instance, editor, type):
-        manager = getattr(instance, self.manager_name)
-        attrs = {}
-        for field in self.get_important_field_names(instance):
-            attrs[field] = getattr(instance, field)
-        manager.create(history_type=type, history_editor=editor, **attrs)
+    @contextmanager
+    def collect_deleted(self):
+        """
+        Collect the attributes of the instances deleted inside the block in
+        a list instead of creating one historical record for each of them.
+        """
+        previous = getattr(self._local, 'deleted', None)
+        self._local.deleted = deleted = []
+        try:
+            yield deleted
+        finally:
+            self._local.deleted = previous
+
+    def get_historical_attrs(self, instance):
+        return self.plan.attrs(instance)
+
+    def create_historical_record(self, instance, editor, type, fingerprint=None):
+        attrs = self.get_historical_attrs(instance)
+        extra = {'history_type': type, 'history_editor': editor}
+        if self._fingerprint:
+            extra['history_fingerprint'] = fingerprint or self.plan.fingerprint(self.plan.values(instance))
+        if self._buffered:
+            record = self.history_model(**dict(attrs, **extra))
+            buffer.add(record, (self.history_model, instance.pk), instance._state.db)
+            return
+        if self._writer is not None:
+            record = self.history_model(**dict(attrs, **extra))
+            self._writer.write([record], instance._state.db)
+            return
+        if self._coalesce_seconds and type == '~' and self.coalesce_record(instance, attrs, extra):
+            return
+        if self._keyframe_interval and type == '~':
+            attrs = self.get_delta_attrs(instance, attrs)
+        if self._versioned:
+            extra['history_version'] = self.get_next_versions([instance.pk])[instance.pk]
+        self.history_model(**dict(attrs, **extra)).save(force_insert=True, using=self.db_for_write())
+        if self._cache is not None:
+            self._cache.invalidate(self.history_model, instance.pk)
+
+    def coalesce_record(self, instance, attrs, extra):
+        """
+        Update the most recent historical record of instance when it is a
+        change created less than coalesce_seconds ago, and return whether
+        it was. Its history_date is kept, so that a busy object still gets a
+        new record every coalesce_seconds. A delta-encoded record becomes a
+        keyframe.
+        """
+        history = self.history_model._base_manager.using(self.db_for_write()) \
+                                                  .filter(**{self.plan.pk_name: instance.pk})
+        latest = list(history.order_by('-history_id')
+                             .values_list('history_id', 'history_type', 'history_date')[:1])
+        since = timezone.now() - datetime.timedelta(seconds=self._coalesce_seconds)
+        if not latest or latest[0][1] != '~' or latest[0][2] < since:
+            return False
+        values = dict(attrs, **extra)
+        del values['history_type']
+        if self._keyframe_interval:
+            values['history_delta'] = None
+        history.filter(history_id=latest[0][0]).update(**values)
+        if self._cache is not None:
+            self._cache.invalidate(self.history_model, instance.pk)
+        return True
+
+    def get_delta_attrs(self, instance, attrs):
+        """
+        Return the attributes of a delta-encoded record for a change of
+        instance, or attrs itself when the record must be a keyframe.
+        """
+        names = self.plan.names
+        pk_name = self.plan.pk_name
+        history = self.history_model._base_manager.using(self.db_for_write()) \
+                                                  .filter(**{pk_name: instance.pk})
+        try:
+            states = walk_back(state_rows(history, names), names, self.plan.field_map)
+        except BrokenHistory:
+            return attrs
+        if not states or len(states) >= self._keyframe_interval:
+            return attrs
+        previous = states[-1][2]
+        changes = dict((name, value) for name, value in attrs.items()
+                       if previous.get(name) != value)
+        delta = dict((name, None) for name in names)
+        delta[pk_name] = instance.pk
+        delta['history_delta'] = encode_delta(changes)
+        return delta
+
+    def get_pending_record(self, instance):
+        """
+        Return the buffered or queued historical record of instance which
+        has not been saved yet, if there is one.
+        """
+        if self._buffered:
+            return buffer.pending((self.history_model, instance.pk), instance._state.db)
+        if self._writer is not None:
+            return self._writer.pending((self.history_model, instance.pk), instance._state.db)
+        return None
+
+    def create_historical_records(self, attrs_list, editor, type, using=None):
+        """
+        Create a historical record for every dictionary of attributes in
+        attrs_list with a single bulk_create(). using is the database of
+        the objects.
+        """
+        records = self.build_historical_records(attrs_list, editor, type)
+        if records:
+            with self._instrumentation.timer(self.model, 'write', len(records)):
+                if self._buffered:
+                    # Behind the records of save() which are still buffered.
+                    pk_name = self.plan.pk_name
+                    keys = [(self.history_model, getattr(record, pk_name)) for record in records]
+                    buffer.extend(records, keys, using or router.db_for_write(self.model))
+                else:
+                    self.write_records(records, using)
+
+    def build_historical_records(self, attrs_list, editor, type):
+        """
+        Return unsaved historical records for every dictionary of attributes
+        in attrs_list, all with the same history_date.
+        """
+        now = timezone.now()
+        records = [self.history_model(history_type=type, history_editor=editor,
+                                      history_date=now, **attrs)
+                   for attrs in attrs_list]
+        if self._fingerprint:
+            for record in records:
+                record.history_fingerprint = self.plan.fingerprint(self.plan.values(record))
+        if self._versioned and records:
+            pk_name = self.plan.pk_name
+            versions = self.get_next_versions([getattr(record, pk_name) for record in records])
+            for record in records:
+                object_pk = getattr(record, pk_name)
+                record.history_version = versions[object_pk]
+                versions[object_pk] += 1
+        return records
+
+    def get_next_versions(self, pks):
+        """
+        Return a dictionary of the history_version of the next historical
+        record of the objects with the given primary keys.
+        """
+        pk_name = self.plan.pk_name
+        history = self.history_model._base_manager.using(self.db_for_write())
+        latest = history.filter(**{'%s__in' % pk_name: pks}).order_by() \
+                        .values(pk_name).annotate(latest_id=models.Max('history_id')) \
+                        .values('latest_id')
+        versions = dict((object_pk, 1) for object_pk in pks)
+        for object_pk, version in history.filter(history_id__in=latest) \
+                                         .values_list(pk_name, 'history_version'):
+            if version is None:
+                # Saved before versions were enabled.
+                version = history.filter(**{pk_name: object_pk}).count()
+            versions[object_pk] = version + 1
+        return versions
+
+    def db_for_write(self):
+        """
+        Return the database alias historical records are written to.
+        """
+        return self._using or router.db_for_write(self.history_model)
+
+    def db_for_read(self):
+        """
+        Return the database alias the history manager reads from, or None
+        to leave it to the routers.
+        """
+        return self._read_using or self._using
+
+    def write_records(self, records, using=None):
+        """
+        Save historical records through the writer, if there is one.
+        """
+        if self._writer is not None:
+            self._writer.write(records, using)
+        else:
+            save_records(records)
+
+    def create_historical_records_for_pks(self, model, pks, editor, type,
+                                          using=None, chunk_size=1000):
+        """
+        Read the current state of the objects with the given primary keys in
+        chunks, and create a historical record for each of them.
+        """
+        names = self.plan.names
+        queryset = model._base_manager.using(using)
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            attrs_list = queryset.filter(pk__in=chunk).values(*names)
+            self.create_historical_records(attrs_list, editor, type, using)
 
 class HistoricalObjectDescriptor(object):
-    def __init__(self, model, important_fields):
+    def __init__(self, model, plan):
         self.model = model
-        self.important_fields = important_fields
+        self.plan = plan
 
     def __get__(self, instance, owner):
-        values = dict( (f, getattr(instance, f)) for f in self.important_fields)
-        return self.model(**values)
+        if instance is None:
+            return self
+        records = owner._historical_records
+        if records._keyframe_interval:
+            rebuild_entries(records, [instance], instance._state.db)
+        return self.plan.build(self.plan.values(instance))
@@ -0,0 +1,93 @@
+import datetime
+import decimal
+import hashlib
+from operator import attrgetter
+
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+
+class FieldPlan(object):
+    """
+    Everything about the fields that we care about which the capture,
+    comparison and reconstruction of historical records need, computed once
+    per model by HistoricalRecords.finalize().
+
+    - fields: the important fields, in model order
+    - names: their attnames, which are also the attnames on the historical
+      model
+    - field_map, verbose_names, positions: dictionaries keyed by attname
+    - pk_name: the attname of the primary key
+    - values(obj): a tuple with the values of the fields of obj, which is an
+      instance of the model or of its historical model
+    - fingerprint(values): a hash of such a tuple
+    """
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = list(fields)
+        self.names = [f.attname for f in self.fields]
+        self.field_map = dict((f.attname, f) for f in self.fields)
+        self.verbose_names = dict((f.attname, f.verbose_name) for f in self.fields)
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        self.pk_name = model._meta.pk.attname
+
+        getter = attrgetter(*self.names)
+        if len(self.names) == 1:
+            self.values = lambda obj: (getter(obj),)
+        else:
+            self.values = getter
+
+        # Model.__init__ takes positional arguments in the order of the
+        # concrete fields, which is faster than keyword arguments.
+        self.positional = self.names == [f.attname for f in model._meta.concrete_fields]
+
+    def attrs(self, obj):
+        return dict(zip(self.names, self.values(obj)))
+
+    def build(self, values, model=None):
+        """
+        Create an instance of the model, or of model, from a sequence of
+        values in the order of names.
+        """
+        if model is None or model is self.model:
+            if self.positional:
+                return self.model(*values)
+            model = self.model
+        return model(**dict(zip(self.names, values)))
+
+    def snapshot(self, instance):
+        """
+        Return a tuple with the values of the fields of instance, or None
+        when some of them are deferred and would need a query.
+        """
+        values = instance.__dict__
+        for name in self.names:
+            if name not in values:
+                return None
+        return tuple(values[name] for name in self.names)
+
+    def fingerprint(self, values):
+        """
+        Return a stable hash of a sequence of values in the order of names,
+        as 40 hexadecimal characters. Values are converted with the
+        to_python() of their field first, so that e.g. '1.5' and
+        Decimal('1.50') have the same fingerprint, and floats are hashed
+        with all their digits.
+        """
+        digest = hashlib.sha1()
+        for field, value in zip(self.fields, values):
+            if value is None:
+                digest.update(b'-')
+                continue
+            value = field.to_python(value)
+            if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+                value = value.astimezone(timezone.utc)
+            elif isinstance(value, decimal.Decimal) and getattr(field, 'decimal_places', None) is not None:
+                value = value.quantize(decimal.Decimal(1).scaleb(-field.decimal_places))
+            elif isinstance(value, float):
+                # str() only keeps 12 significant digits on Python 2.
+                value = repr(value)
+            data = force_bytes(value)
+            digest.update(force_bytes('%d:' % len(data)))
+            digest.update(data)
+        return digest.hexdigest()
@@ -0,0 +1,197 @@
+"""
+Retention policies, which delete old historical records.
+
+    from history.retention import compact
+    compact(MyModel, keep_last=10, thin='day', before=now - timedelta(days=90))
+
+The records are read in chunks of rows, using keyset pagination on the
+primary key and history_id, and deleted in chunks of history_id with one
+transaction per chunk, so that no query runs over the whole table and
+objects with many records are never loaded at once.
+The most recent record of every object and the records of deletions are
+always kept.
+"""
+import itertools
+import operator
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from history.delta import state_rows, walk_back
+
+PERIODS = {
+    'day': lambda date: date.date(),
+    'week': lambda date: date.isocalendar()[:2],
+    'month': lambda date: (date.year, date.month),
+}
+
+
+def select_deleted(rows, keep_last=None, thin=None, before=None):
+    """
+    Return the history_ids to delete among rows of (history_id,
+    history_type, history_date) of one object, newest first.
+
+    Records older than before, or all of them, are deleted except the
+    keep_last newest ones and, with thin, the newest one of every day,
+    week or month.
+    """
+    return [row[0] for row, keep in retained(rows, keep_last, thin, before) if not keep]
+
+
+def retained(rows, keep_last=None, thin=None, before=None):
+    """
+    Yield (row, keep) for rows of (history_id, history_type, history_date,
+    ...) of one object, newest first, see select_deleted().
+    """
+    periods = set()
+    for i, row in enumerate(rows):
+        history_id, history_type, history_date = row[:3]
+        keep = i == 0 or history_type == '-' or (keep_last is not None and i < keep_last) or \
+               (before is not None and history_date >= before)
+        if thin is not None:
+            if timezone.is_aware(history_date):
+                history_date = timezone.localtime(history_date)
+            period = PERIODS[thin](history_date)
+            keep = keep or period not in periods
+            periods.add(period)
+        yield row, keep
+
+
+def compact(model, keep_last=None, thin=None, before=None, chunk_size=1000,
+            start_after=None, using=None, dry_run=False, progress=None):
+    """
+    Apply a retention policy to the historical records of model, see
+    select_deleted(). Objects are processed in primary key order, starting
+    after the primary key start_after to resume an interrupted run.
+    progress is called with (model, last primary key, objects, deleted)
+    after every chunk of objects.
+
+    With delta-encoded records, kept records whose previous record is
+    deleted are turned into keyframes first. With versioned records, the
+    history_version of the most recent record of an object becomes the
+    number of records left.
+
+    Returns the number of objects and of deleted records.
+    """
+    if keep_last is None and thin is None and before is None:
+        raise ValueError('Give at least one of keep_last, thin and before.')
+    if thin is not None and thin not in PERIODS:
+        raise ValueError('Unknown period %r, use one of %s.' % (thin, ', '.join(sorted(PERIODS))))
+
+    records = model._historical_records
+    pk_name = records.plan.pk_name
+    using = using or records.db_for_write()
+    history = records.history_model._base_manager.using(using)
+    delta = bool(records._keyframe_interval)
+    columns = [pk_name, 'history_id', 'history_type', 'history_date']
+    if delta:
+        columns.append('history_delta')
+    if records._versioned:
+        columns.append('history_version')
+
+    objects = deleted = 0
+    object_pk = None
+    ids = []
+    keyframes = {}
+    versions = {}
+
+    def flush():
+        if not dry_run:
+            delete_records(records, history, ids, keyframes, versions)
+        del ids[:]
+        keyframes.clear()
+        versions.clear()
+
+    rows = read_rows(history, columns, start_after, chunk_size)
+    for object_pk, object_rows in itertools.groupby(rows, key=operator.itemgetter(0)):
+        # The history_id of the newer record, when it's a kept delta
+        newer_delta = None
+        newest = None
+        kept = 0
+        for row, keep in retained((row[1:] for row in object_rows), keep_last, thin, before):
+            if newest is None:
+                newest = row
+            if keep:
+                kept += 1
+                newer_delta = row[0] if delta and row[3] is not None else None
+                continue
+            if newer_delta is not None:
+                keyframes.setdefault(object_pk, []).append(newer_delta)
+                newer_delta = None
+            ids.append(row[0])
+            deleted += 1
+            if len(ids) == chunk_size:
+                flush()
+        if records._versioned and newest[-1] is not None and newest[-1] != kept:
+            # The most recent record keeps the number of records, for
+            # count_versions().
+            versions[newest[0]] = kept
+
+        objects += 1
+        if objects % chunk_size == 0:
+            flush()
+            if progress is not None:
+                progress(model, object_pk, objects, deleted)
+
+    if objects % chunk_size:
+        flush()
+        if progress is not None:
+            progress(model, object_pk, objects, deleted)
+    return objects, deleted
+
+
+def read_rows(history, columns, start_after=None, chunk_size=1000):
+    """
+    Yield the values of columns of the historical records, the first of
+    which is the primary key, by object and newest first, reading chunks
+    of chunk_size rows with keyset pagination.
+    """
+    pk_name = columns[0]
+    queryset = history.order_by(pk_name, '-history_id').values_list(*columns)
+    if start_after is not None:
+        queryset = queryset.filter(**{'%s__gt' % pk_name: start_after})
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(models.Q(**{'%s__gt' % pk_name: last[0]}) |
+                                 models.Q(**{pk_name: last[0], 'history_id__lt': last[1]}))
+        chunk = list(chunk[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1][:2]
+
+
+def delete_records(records, history, ids, keyframes, versions):
+    """
+    Turn the records in keyframes, a dictionary of object primary keys to
+    history_ids, into keyframes, and then delete the records in ids and
+    set the history_version of the records in versions, a dictionary of
+    history_ids to versions.
+    """
+    using = history.db
+    for object_pk, history_ids in keyframes.items():
+        with transaction.atomic(using=using):
+            make_keyframes(records, history, object_pk, history_ids)
+    if ids or versions:
+        with transaction.atomic(using=using):
+            if ids:
+                history.filter(history_id__in=ids).delete()
+            for history_id, version in versions.items():
+                history.filter(history_id=history_id).update(history_version=version)
+
+
+def make_keyframes(records, history, object_pk, history_ids):
+    """
+    Replace the deltas of the given records of an object with a full copy
+    of their fields.
+    """
+    names = records.plan.names
+    rows = state_rows(history.filter(**{records.plan.pk_name: object_pk,
+                                        'history_id__lte': max(history_ids)}), names)
+    states = dict((history_id, values) for history_id, history_type, values
+                  in walk_back(rows, names, records.plan.field_map, min_id=min(history_ids)))
+    for history_id in history_ids:
+        history.filter(history_id=history_id).update(history_delta=None, **states[history_id])
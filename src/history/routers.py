@@ -0,0 +1,53 @@
+from django.apps import apps
+
+
+class HistoryRouter(object):
+    """
+    Database router for the historical models of
+    HistoricalRecords(using=..., read_using=...). It sends the queries
+    which don't choose a database themselves, like those of the admin, to
+    the right one, only creates the historical tables in these databases,
+    and allows relations between them and the tracked models.
+
+    Usage, in the settings:
+    DATABASE_ROUTERS = ['history.routers.HistoryRouter']
+    """
+    def _records(self, model):
+        """
+        Return the HistoricalRecords of a routed historical model, or None.
+        """
+        records = getattr(model, '_historical_records', None)
+        if records is None or records.history_model is not model or not records._using:
+            return None
+        return records
+
+    def db_for_read(self, model, **hints):
+        records = self._records(model)
+        if records is not None:
+            return records.db_for_read()
+        return None
+
+    def db_for_write(self, model, **hints):
+        records = self._records(model)
+        if records is not None:
+            return records._using
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self._records(obj1.__class__) or self._records(obj2.__class__):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name is None:
+            return None
+        # Migrations pass the models of their state, which don't have the
+        # HistoricalRecords attached.
+        try:
+            model = apps.get_model(app_label, model_name)
+        except LookupError:
+            return None
+        records = self._records(model)
+        if records is not None:
+            return db in (records._using, records.db_for_read())
+        return None
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent by history.instrumentation.SignalSink for every measured phase of the
+# capture of historical records, with the model as sender.
+history_metric = Signal(providing_args=['phase', 'duration', 'count'])
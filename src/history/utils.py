@@ -1,3 +1,5 @@
+from django.apps import apps
+
 from history.models import HistoricalRecords
 
 
@@ -20,3 +22,23 @@ def monkeypatch_history_for_model(model, attribute_name, module):
     history.contribute_to_class(model, attribute_name)
     history.finalize(model)
 
+
+
+def get_tracked_models(labels=None):
+    """
+    Return the models with HistoricalRecords, or those among the given
+    'app_label.ModelName' labels, which raise LookupError when they don't
+    exist and ValueError when they have no HistoricalRecords.
+    """
+    if not labels:
+        return [model for model in apps.get_models()
+                if getattr(model, '_historical_records', None) is not None and
+                model._historical_records.model is model]
+    models = []
+    for label in labels:
+        model = apps.get_model(label)
+        records = getattr(model, '_historical_records', None)
+        if records is None or records.model is not model:
+            raise ValueError('%s has no HistoricalRecords.' % label)
+        models.append(model)
+    return models
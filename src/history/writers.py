@@ -0,0 +1,244 @@
+"""
+Writers take the historical records created by HistoricalRecords and save
+them to the database.
+
+Usage:
+class MyModel(models.Model):
+    ...
+    history = HistoricalRecords(writer=QueuedWriter(workers=2))
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.utils.six.moves import queue
+
+logger = logging.getLogger('history')
+
+
+def save_records(records):
+    """
+    Save historical records with one bulk_create() per historical model.
+    """
+    if len(records) == 1:
+        records[0].save(using=records[0]._historical_records.db_for_write())
+        return
+    by_model = {}
+    for record in records:
+        by_model.setdefault(record.__class__, []).append(record)
+    for model, model_records in by_model.items():
+        model._default_manager.using(model._historical_records.db_for_write()) \
+                              .bulk_create(model_records)
+
+
+class SyncWriter(object):
+    """
+    Saves historical records right away, in the thread which created them.
+    """
+    def write(self, records, using=None):
+        save_records(records)
+
+    def pending(self, key, using):
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueuedWriter(object):
+    """
+    Saves historical records from a pool of background threads, in batches.
+
+    Records are put in a bounded queue when the transaction they were
+    created in commits. The records of an object always go to the same
+    worker, so that they are saved in order. When a queue is full, policy
+    decides what happens: 'block' waits until there is room again, 'spill'
+    saves the records in the calling thread instead, once the records of
+    the same object queued before them are saved.
+
+    Until they are saved, pending() returns the last record of an object,
+    so that HistoricalRecords compares a new save with it rather than with
+    the database. flush() waits until everything queued has been saved, and close() also
+    stops the workers; it is called when the interpreter exits. With the
+    HISTORY_SYNCHRONOUS_WRITES setting, records are saved right away, which
+    is convenient for tests.
+    """
+    POLICIES = ('block', 'spill')
+
+    def __init__(self, maxsize=10000, workers=2, batch_size=500, policy='block'):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown policy %r, use one of %s.' % (policy, ', '.join(self.POLICIES)))
+        self.maxsize = maxsize
+        self.workers = workers
+        self.batch_size = batch_size
+        self.policy = policy
+        self._queues = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._saved_condition = threading.Condition(self._lock)
+        # Records queued and not saved yet, by key, oldest first
+        self._queued = {}
+        # Records being saved by the calling thread, by id()
+        self._spilling = {}
+        # Records waiting for their transaction to commit, in this thread
+        self._local = threading.local()
+
+    def write(self, records, using=None):
+        if getattr(settings, 'HISTORY_SYNCHRONOUS_WRITES', False):
+            save_records(records)
+            return
+        waiting = self._waiting(using)
+        if not transaction.get_connection(using).in_atomic_block:
+            # Anything left was rolled back.
+            waiting.clear()
+
+        def enqueue():
+            self._enqueue(records, using)
+        for record in records:
+            waiting.setdefault(self._key(record), []).append((record, enqueue))
+        transaction.on_commit(enqueue, using=using)
+
+    def pending(self, key, using):
+        """
+        Return the last record written for key which has not been saved
+        yet, or None. key is (historical model, primary key).
+        """
+        waiting = self._waiting(using).get(key)
+        if waiting:
+            connection = transaction.get_connection(using)
+            callbacks = set(func for sids, func in connection.run_on_commit)
+            # Drop the records of rolled back savepoints.
+            while waiting and waiting[-1][1] not in callbacks:
+                waiting.pop()
+            if waiting:
+                return waiting[-1][0]
+        with self._lock:
+            queued = self._queued.get(key)
+            return queued[-1] if queued else None
+
+    def _key(self, record):
+        pk_name = record._historical_records.model._meta.pk.attname
+        return (record.__class__, getattr(record, pk_name))
+
+    def _waiting(self, using):
+        try:
+            by_alias = self._local.waiting
+        except AttributeError:
+            by_alias = self._local.waiting = {}
+        return by_alias.setdefault(using, {})
+
+    def _saved(self, records):
+        with self._lock:
+            for record in records:
+                key = self._key(record)
+                queued = [other for other in self._queued.get(key, ()) if other is not record]
+                if queued:
+                    self._queued[key] = queued
+                else:
+                    self._queued.pop(key, None)
+                self._spilling.pop(id(record), None)
+            self._saved_condition.notify_all()
+
+    def _earlier(self, record):
+        """
+        Return the records of the object of record queued before it and not
+        saved yet. Must be called with the lock held.
+        """
+        earlier = []
+        for other in self._queued.get(self._key(record), ()):
+            if other is record:
+                break
+            earlier.append(other)
+        return earlier
+
+    def _enqueue(self, records, using=None):
+        waiting = self._waiting(using)
+        with self._lock:
+            for record in records:
+                key = self._key(record)
+                self._queued.setdefault(key, []).append(record)
+                entries = [entry for entry in waiting.get(key, ()) if entry[0] is not record]
+                if entries:
+                    waiting[key] = entries
+                else:
+                    waiting.pop(key, None)
+        queues = self._start()
+        for record in records:
+            pk_name = record._historical_records.model._meta.pk.attname
+            record_queue = queues[hash(getattr(record, pk_name)) % len(queues)]
+            if self.policy == 'block':
+                record_queue.put(record)
+                continue
+            with self._lock:
+                # A worker must not save it before an earlier record which
+                # is being spilled.
+                while any(id(other) in self._spilling for other in self._earlier(record)):
+                    self._saved_condition.wait()
+                try:
+                    record_queue.put_nowait(record)
+                    continue
+                except queue.Full:
+                    self._spilling[id(record)] = record
+                    while self._earlier(record):
+                        self._saved_condition.wait()
+            try:
+                save_records([record])
+            finally:
+                self._saved([record])
+
+    def _start(self):
+        with self._lock:
+            if self._queues is None:
+                size = max(1, self.maxsize // self.workers)
+                self._queues = [queue.Queue(size) for i in range(self.workers)]
+                for record_queue in self._queues:
+                    thread = threading.Thread(target=self._work, args=(record_queue,),
+                                              name='history-writer')
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+                atexit.register(self.close)
+            return self._queues
+
+    def _work(self, record_queue):
+        record = True
+        while record is not None:
+            batch = []
+            record = record_queue.get()
+            while record is not None:
+                batch.append(record)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    record = record_queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                if batch:
+                    close_old_connections()
+                    save_records(batch)
+            except Exception:
+                logger.exception('Could not save %d historical records.', len(batch))
+            finally:
+                self._saved(batch)
+                for i in range(len(batch) + (record is None)):
+                    record_queue.task_done()
+        connections.close_all()
+
+    def flush(self):
+        for record_queue in self._queues or ():
+            record_queue.join()
+
+    def close(self):
+        with self._lock:
+            queues, self._queues = self._queues, None
+            threads, self._threads = self._threads, []
+        for record_queue in queues or ():
+            record_queue.put(None)
+        for thread in threads:
+            thread.join()